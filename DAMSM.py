@@ -161,7 +161,7 @@ class CNN_ENCODER(nn.Module):
         self.emb_features.weight.data.uniform_(-initrange, initrange)
         self.emb_cnn_code.weight.data.uniform_(-initrange, initrange)
 
-    def forward(self, x):
+    def forward(self, x, return_pooled=False):
         features = None
         # --> fixed-size input: batch x 3 x 299 x 299
         x = nn.functional.interpolate(x, size=(299, 299), mode='bilinear', align_corners=False)
@@ -221,4 +221,7 @@ class CNN_ENCODER(nn.Module):
         # 512
         if features is not None:
             features = self.emb_features(features)
+        if return_pooled:
+            # the 2048-d trunk output, shared with the recaption CAPTION_HEAD
+            return features, cnn_code, x
         return features, cnn_code
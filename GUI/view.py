@@ -7,7 +7,7 @@
 @Version     :0.1
 @Description : Implementation of SSA-GAN
 '''
-from model import NetG, NetD
+from model import NetG, NetD, ConditionCache
 from DAMSM import RNN_ENCODER
 import os
 import sys
@@ -206,16 +206,15 @@ def main(args):
     caption_idx = caption_idx.view(1, -1)
     caption_len = caption_len.view(-1)
 
-    # use rnn encoder to get caption embedding
-    hidden = text_encoder.init_hidden(1)
-    words_embs, sent_emb = text_encoder(caption_idx, caption_len, hidden)
+    # caption -> modulation of every NetG block, computed once and cached;
+    # the 1 x C conditions broadcast over all noise samples
+    cond_cache = ConditionCache(text_encoder, netG)
+    condition = cond_cache(caption_idx[0], caption_len[0])
 
     # generate fake image
     noise.data.normal_(0, 1)
-    sent_emb = sent_emb.repeat(num_noise, 1)
-    words_embs = words_embs.repeat(num_noise, 1, 1)
     with torch.no_grad():
-        fake_imgs, fusion_mask = netG(noise, sent_emb)
+        fake_imgs, fusion_mask = netG.synthesize(noise, condition)
 
         # create path to save image, caption and mask
         cap_number = 10000
@@ -26,6 +26,7 @@ http://www.aclweb.org/anthology/D15-1166
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 def conv1x1(in_planes, out_planes):
@@ -34,45 +35,38 @@ def conv1x1(in_planes, out_planes):
                      padding=0, bias=False)
 
 
-def func_attention(query, context, gamma1):
+def func_attention(query, context, gamma1, mask=None):
     """
     query: batch x ndf x queryL
     context: batch x ndf x ih x iw (sourceL=ihxiw)
-    mask: batch_size x sourceL
+    mask: batch x queryL, True for the words to ignore
+
+    Leading batch dimensions broadcast, so a query of n x 1 x ndf x queryL
+    against a context of 1 x batch x ndf x ih x iw attends every query to
+    every context in one pass.
     """
-    batch_size, queryL = query.size(0), query.size(2)
-    ih, iw = context.size(2), context.size(3)
-    sourceL = ih * iw
+    ih, iw = context.size(-2), context.size(-1)
 
-    # --> batch x sourceL x ndf
-    context = context.view(batch_size, -1, sourceL)
-    contextT = torch.transpose(context, 1, 2).contiguous()
+    # --> batch x ndf x sourceL
+    context = context.flatten(-2)
 
     # Get attention
     # (batch x sourceL x ndf)(batch x ndf x queryL)
     # -->batch x sourceL x queryL
-    attn = torch.bmm(contextT, query)  # Eq. (7) in AttnGAN paper
-    # --> batch*sourceL x queryL
-    attn = attn.view(batch_size * sourceL, queryL)
-    attn = nn.Softmax()(attn)  # Eq. (8)
-
-    # --> batch x sourceL x queryL
-    attn = attn.view(batch_size, sourceL, queryL)
-    # --> batch*queryL x sourceL
-    attn = torch.transpose(attn, 1, 2).contiguous()
-    attn = attn.view(batch_size * queryL, sourceL)
+    attn = torch.matmul(context.transpose(-1, -2), query)  # Eq. (7) in AttnGAN paper
+    if mask is not None:
+        attn = attn.masked_fill(mask.unsqueeze(-2), -float('inf'))
+    attn = F.softmax(attn, dim=-1)  # Eq. (8)
+
+    # --> batch x queryL x sourceL
     #  Eq. (9)
-    attn = attn * gamma1
-    attn = nn.Softmax()(attn)
-    attn = attn.view(batch_size, queryL, sourceL)
-    # --> batch x sourceL x queryL
-    attnT = torch.transpose(attn, 1, 2).contiguous()
+    attn = F.softmax(attn.transpose(-1, -2) * gamma1, dim=-1)
 
     # (batch x ndf x sourceL)(batch x sourceL x queryL)
     # --> batch x ndf x queryL
-    weightedContext = torch.bmm(context, attnT)
+    weightedContext = torch.matmul(context, attn.transpose(-1, -2))
 
-    return weightedContext, attn.view(batch_size, -1, ih, iw)
+    return weightedContext, attn.reshape(attn.shape[:-1] + (ih, iw))
 
 
 class GlobalAttentionGeneral(nn.Module):
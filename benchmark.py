@@ -0,0 +1,388 @@
+# -*- encoding: utf-8 -*-
+"""Micro-benchmarks of the SSA-GAN training and inference paths.
+
+Each subcommand times one component (attention, D step, export,
+activation checkpointing, recaption loss) against its alternatives.
+
+    python benchmark.py <subcommand> --help
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.transforms as transforms
+
+from miscc.config import cfg, cfg_from_file
+from GlobalAttention import func_attention
+from miscc.losses import magp_loss, recaption_loss
+from miscc.utils import autocast, grad_scaler, scaled_step
+from model import NetG, NetD, export_netG, CAPTION_RNN, caption_encoder
+from datasets import TextDataset, collate_data, prepare_batch
+from DAMSM import CNN_ENCODER
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark parts of SSA-GAN')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file',
+                        default='cfg/bird.yml', type=str)
+    parser.add_argument('--gpu', dest='gpu_id', type=int, default=0)
+    parser.add_argument('--iters', dest='iters', type=int, default=20)
+    parser.add_argument('--warmup', dest='warmup', type=int, default=3)
+    parser.add_argument('--amp', dest='amp_dtype', type=str, default='',
+                        choices=['', 'float16', 'bfloat16'],
+                        help='run with TRAIN.AMP in this dtype')
+    subparsers = parser.add_subparsers(dest='bench')
+
+    attention = subparsers.add_parser('attention', help='func_attention in words_loss')
+    attention.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 32, 64])
+    attention.add_argument('--seq_lens', type=int, nargs='+', default=[10, 18, 25])
+
+    dstep = subparsers.add_parser('dstep', help='discriminator update with MA-GP')
+    dstep.add_argument('--batch_size', type=int, default=32)
+    dstep.add_argument('--interval', type=int, default=4,
+                       help='k of the lazy regularization run')
+
+    export = subparsers.add_parser('export', help='CPU inference of the exported NetG')
+    export.add_argument('--batch_size', type=int, default=8)
+    export.add_argument('--model', type=str, default='', help='netG_*.pth to load')
+    export.add_argument('--jit', action='store_true', help='also trace with torch.jit')
+    export.add_argument('--compile', action='store_true', help='also run torch.compile')
+
+    ckpt = subparsers.add_parser('checkpoint', help='activation checkpointing of NetG / NetD')
+    ckpt.add_argument('--batch_size', type=int, default=8)
+    ckpt.add_argument('--settings', type=str, nargs='+',
+                      default=['-/-', 'block5,block6/-', '-/conv_img,block0,block1',
+                               'block5,block6/conv_img,block0,block1'],
+                      help='G blocks/D layers per run, comma separated, - for none')
+
+    recap = subparsers.add_parser('recaption', help='recaption loss per CAP.BACKBONE')
+    recap.add_argument('--batch_size', type=int, default=8)
+    recap.add_argument('--batches', type=int, default=50,
+                       help='test batches for the loss correlation')
+    recap.add_argument('--inception_path', type=str, default='',
+                       help='CAPTION_HEAD weights of distill.py --backbone inception')
+    recap.add_argument('--distilled_path', type=str, default='',
+                       help='CAPTION_CNN_LITE weights of distill.py --backbone distilled')
+
+    args = parser.parse_args()
+    return args
+
+
+def get_device(gpu_id):
+    if gpu_id >= 0 and torch.cuda.is_available():
+        torch.cuda.set_device(gpu_id)
+        return torch.device('cuda', gpu_id)
+    return torch.device('cpu')
+
+
+def timeit(fn, iters, warmup, device):
+    """Mean wall time of fn() in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start) * 1000.0 / iters
+
+
+def legacy_func_attention(query, context, gamma1):
+    """func_attention before the fused rewrite, kept as the reference."""
+    batch_size, queryL = query.size(0), query.size(2)
+    ih, iw = context.size(2), context.size(3)
+    sourceL = ih * iw
+
+    context = context.view(batch_size, -1, sourceL)
+    contextT = torch.transpose(context, 1, 2).contiguous()
+
+    attn = torch.bmm(contextT, query)
+    attn = attn.view(batch_size * sourceL, queryL)
+    attn = nn.Softmax(dim=1)(attn)
+
+    attn = attn.view(batch_size, sourceL, queryL)
+    attn = torch.transpose(attn, 1, 2).contiguous()
+    attn = attn.view(batch_size * queryL, sourceL)
+    attn = attn * gamma1
+    attn = nn.Softmax(dim=1)(attn)
+    attn = attn.view(batch_size, queryL, sourceL)
+    attnT = torch.transpose(attn, 1, 2).contiguous()
+
+    weightedContext = torch.bmm(context, attnT)
+
+    return weightedContext, attn.view(batch_size, -1, ih, iw)
+
+
+def bench_attention(args, device):
+    """Per-caption legacy loop against the broadcast fused call.
+
+    Both attend every caption to every image as words_loss does; the
+    weighted contexts are compared on the unpadded words.
+    """
+    gamma1 = cfg.TRAIN.SMOOTH.GAMMA1
+    nef = cfg.TEXT.EMBEDDING_DIM
+    print('%6s %6s %12s %12s %8s %10s' % ('batch', 'seq', 'legacy(ms)', 'fused(ms)',
+                                          'speedup', 'max|diff|'))
+    for batch_size in args.batch_sizes:
+        for seq_len in args.seq_lens:
+            words_emb = torch.randn(batch_size, nef, seq_len, device=device)
+            img_features = torch.randn(batch_size, nef, 17, 17, device=device)
+            cap_lens = torch.randint(1, seq_len + 1, (batch_size,), device=device)
+            cap_lens[0] = seq_len
+            pad = torch.arange(seq_len, device=device).unsqueeze(0) >= cap_lens.unsqueeze(1)
+            words_nums = cap_lens.tolist()
+
+            def legacy():
+                out = []
+                for i in range(batch_size):
+                    word = words_emb[i, :, :words_nums[i]].unsqueeze(0).contiguous()
+                    word = word.repeat(batch_size, 1, 1)
+                    out.append(legacy_func_attention(word, img_features, gamma1)[0])
+                return out
+
+            def fused():
+                return func_attention(words_emb.unsqueeze(1), img_features.unsqueeze(0),
+                                      gamma1, pad.unsqueeze(1))[0]
+
+            with torch.no_grad():
+                ref = legacy()
+                out = fused()
+                diff = max((out[i, :, :, :words_nums[i]] - ref[i]).abs().max().item()
+                           for i in range(batch_size))
+                t_legacy = timeit(legacy, args.iters, args.warmup, device)
+                t_fused = timeit(fused, args.iters, args.warmup, device)
+            print('%6d %6d %12.3f %12.3f %7.2fx %10.2e' % (batch_size, seq_len, t_legacy, t_fused,
+                                                         t_legacy / t_fused, diff))
+
+
+def bench_dstep(args, device):
+    """Iterations/sec and peak memory of the discriminator update.
+
+    Runs the hinge and MA-GP losses of one caption branch of main.train
+    with the penalty as its own update ('separate'), folded into the hinge
+    backward ('joint'), and applied lazily every --interval steps.
+    """
+    batch_size = args.batch_size
+    imsize = cfg.TREE.BASE_SIZE
+    netD = nn.DataParallel(NetD(cfg.TRAIN.NF).to(device))
+    optimizerD = torch.optim.Adam(netD.parameters(), lr=0.0004, betas=(0.0, 0.9))
+    imgs = torch.randn(batch_size, 3, imsize, imsize, device=device)
+    fake = torch.randn(batch_size, 3, imsize, imsize, device=device)
+    sent_emb = torch.randn(batch_size, cfg.TEXT.EMBEDDING_DIM, device=device)
+    scalerD = grad_scaler(device)
+
+    def run(mode, interval):
+        counter = [0]
+
+        def step():
+            use_gp = counter[0] % interval == 0
+            joint_gp = use_gp and mode == 'joint'
+            counter[0] += 1
+            real, sent_real = imgs, sent_emb
+            if joint_gp:
+                real = imgs.data.requires_grad_()
+                sent_real = sent_emb.data.requires_grad_()
+            with autocast(device):
+                real_features = netD(real)
+                out_real = netD.module.COND_DNET(real_features, sent_real)
+                errD_real = torch.nn.ReLU()(1.0 - out_real).mean()
+                output = netD.module.COND_DNET(real_features[:(batch_size - 1)], sent_emb[1:batch_size])
+                errD_mismatch = torch.nn.ReLU()(1.0 + output).mean()
+                output = netD.module.COND_DNET(netD(fake), sent_emb)
+                errD_fake = torch.nn.ReLU()(1.0 + output).mean()
+                errD = errD_real + (errD_fake + errD_mismatch) / 2.0
+                if joint_gp:
+                    errD = errD + 2.0 * interval * magp_loss(netD, real, sent_real, out_real, scalerD)
+            scaled_step(scalerD, optimizerD, errD)
+            if use_gp and not joint_gp:
+                with autocast(device):
+                    d_loss = 2.0 * interval * magp_loss(netD, imgs, sent_emb, scaler=scalerD)
+                scaled_step(scalerD, optimizerD, d_loss)
+        return step
+
+    print('%-20s %10s %14s' % ('mode', 'it/s', 'peak mem (MB)'))
+    for name, mode, interval in [('separate', 'separate', 1),
+                                 ('joint', 'joint', 1),
+                                 ('separate, k=%d' % args.interval, 'separate', args.interval),
+                                 ('joint, k=%d' % args.interval, 'joint', args.interval)]:
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+        iters = max(args.iters, interval)
+        ms = timeit(run(mode, interval), iters, args.warmup, device)
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+        print('%-20s %10.2f %14.1f' % (name, 1000.0 / ms, peak))
+
+
+def bench_export(args):
+    """Images/sec of NetG at 256x256 on the CPU, before and after export."""
+    device = torch.device('cpu')
+    netG = NetG(cfg.TRAIN.NF, 100)
+    if args.model:
+        state_dict = torch.load(args.model, map_location=lambda storage, loc: storage)
+        netG.load_state_dict({k.replace('module.', '', 1): v for k, v in state_dict.items()})
+    netG.eval()
+    noise = torch.randn(args.batch_size, 100)
+    sent_emb = torch.randn(args.batch_size, cfg.TEXT.EMBEDDING_DIM)
+
+    models = [('eager', netG), ('exported', export_netG(netG))]
+    if args.jit:
+        models.append(('exported + jit', export_netG(netG, example_inputs=(noise, sent_emb))))
+    if args.compile and hasattr(torch, 'compile'):
+        models.append(('exported + compile', torch.compile(export_netG(netG))))
+
+    print('%-20s %10s %10s' % ('model', 'img/s', 'max|diff|'))
+    with torch.no_grad():
+        ref = netG(noise, sent_emb)[0]
+        for name, model in models:
+            diff = (model(noise, sent_emb)[0] - ref).abs().max().item()
+            ms = timeit(lambda: model(noise, sent_emb), args.iters, args.warmup, device)
+            print('%-20s %10.2f %10.2e' % (name, args.batch_size * 1000.0 / ms, diff))
+
+
+def bench_checkpoint(args, device):
+    """Iterations/sec and peak memory of a D (hinge + MA-GP) and G update
+    for each TRAIN.CHECKPOINT_G / TRAIN.CHECKPOINT_D setting."""
+    batch_size = args.batch_size
+    imsize = cfg.TREE.BASE_SIZE
+    imgs = torch.randn(batch_size, 3, imsize, imsize, device=device)
+    sent_emb = torch.randn(batch_size, cfg.TEXT.EMBEDDING_DIM, device=device)
+
+    print('%-45s %10s %14s' % ('G / D checkpoint', 'it/s', 'peak mem (MB)'))
+    for setting in args.settings:
+        names_G, names_D = [[n for n in part.split(',') if n and n != '-']
+                            for part in setting.split('/')]
+        netG = nn.DataParallel(NetG(cfg.TRAIN.NF, 100, checkpoint=names_G).to(device))
+        netD = nn.DataParallel(NetD(cfg.TRAIN.NF, checkpoint=names_D).to(device))
+        optimizerG = torch.optim.Adam(netG.parameters(), lr=0.0001, betas=(0.0, 0.9))
+        optimizerD = torch.optim.Adam(netD.parameters(), lr=0.0004, betas=(0.0, 0.9))
+
+        def step():
+            real_features = netD(imgs)
+            errD_real = torch.nn.ReLU()(1.0 - netD.module.COND_DNET(real_features, sent_emb)).mean()
+            noise = torch.randn(batch_size, 100, device=device)
+            fake = netG(noise, sent_emb, return_masks=False)
+            errD_fake = netD.module.COND_DNET(netD(fake.detach()), sent_emb)
+            errD = errD_real + torch.nn.ReLU()(1.0 + errD_fake).mean()
+            optimizerD.zero_grad()
+            errD.backward()
+            optimizerD.step()
+
+            d_loss = 2.0 * magp_loss(netD, imgs, sent_emb)
+            optimizerD.zero_grad()
+            d_loss.backward()
+            optimizerD.step()
+
+            errG = - netD.module.COND_DNET(netD(fake), sent_emb).mean()
+            optimizerG.zero_grad()
+            errG.backward()
+            optimizerG.step()
+
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+        ms = timeit(step, args.iters, args.warmup, device)
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+        print('%-45s %10.2f %14.1f' % (setting, 1000.0 / ms, peak))
+        del netG, netD, optimizerG, optimizerD
+
+
+def _frozen(model, path, device):
+    model.load_state_dict(torch.load(path, map_location=lambda storage, loc: storage))
+    for p in model.parameters():
+        p.requires_grad = False
+    return model.to(device).eval()
+
+
+def bench_recaption(args, device):
+    """Step time of the image encoders plus the recaption loss for each
+    CAP.BACKBONE, and the correlation of their losses with the ResNet-152
+    path over test batches.
+
+    Every row includes the CNN_ENCODER forward, which the G step runs for
+    the DAMSM loss anyway and the 'inception' head reuses.
+    """
+    imsize = cfg.TREE.BASE_SIZE
+    cfg.TEXT.EMB_CACHE = False
+    image_transform = transforms.Compose([
+        transforms.Resize(int(imsize * 76 / 64)),
+        transforms.CenterCrop(imsize)])
+    dataset = TextDataset(cfg.DATA_DIR, 'test', base_size=imsize, transform=image_transform)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, drop_last=True, shuffle=True,
+        collate_fn=collate_data, pin_memory=device.type == 'cuda')
+
+    image_encoder = CNN_ENCODER(cfg.TEXT.EMBEDDING_DIM)
+    image_encoder = _frozen(image_encoder, cfg.TEXT.DAMSM_NAME.replace('text_encoder', 'image_encoder'), device)
+    caption_rnn = CAPTION_RNN(cfg.CAP.embed_size, cfg.CAP.hidden_size * 2, 9956, cfg.CAP.num_layers)
+    caption_rnn = _frozen(caption_rnn, cfg.CAP.caption_rnn_path, device)
+    encoders = OrderedDict()
+    for backbone, path in (('resnet152', cfg.CAP.caption_cnn_path),
+                           ('inception', args.inception_path),
+                           ('distilled', args.distilled_path)):
+        if path:
+            encoders[backbone] = _frozen(caption_encoder(backbone, cfg.CAP.embed_size), path, device)
+
+    def loss_fn(backbone, imgs, captions, cap_lens):
+        _, _, pooled = image_encoder(imgs, return_pooled=True)
+        feature = encoders[backbone](pooled if backbone == 'inception' else imgs)
+        return recaption_loss(None, caption_rnn, imgs, captions, cap_lens, device, feature)
+
+    losses = dict((backbone, []) for backbone in encoders)
+    timed = None
+    for step, data in enumerate(dataloader):
+        if step >= args.batches:
+            break
+        imgs, _, captions, cap_lens = prepare_batch(data, device)[:4]
+        imgs = imgs[-1]
+        if timed is None:
+            timed = (imgs, captions, cap_lens)
+        with torch.no_grad():
+            for backbone in encoders:
+                losses[backbone].append(loss_fn(backbone, imgs, captions, cap_lens).item())
+
+    imgs, captions, cap_lens = timed
+    print('%-12s %12s %12s %10s' % ('backbone', 'step (ms)', 'mean loss', 'corr'))
+    for backbone in encoders:
+        def step():
+            x = imgs.detach().requires_grad_()
+            loss_fn(backbone, x, captions, cap_lens).backward()
+        ms = timeit(step, args.iters, args.warmup, device)
+        corr = float('nan')
+        if 'resnet152' in losses:
+            corr = np.corrcoef(losses['resnet152'], losses[backbone])[0, 1]
+        print('%-12s %12.2f %12.4f %10.3f' % (backbone, ms, np.mean(losses[backbone]), corr))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.amp_dtype:
+        cfg.TRAIN.AMP = True
+        cfg.TRAIN.AMP_DTYPE = args.amp_dtype
+    device = get_device(args.gpu_id)
+
+    if args.bench == 'attention':
+        bench_attention(args, device)
+    elif args.bench == 'dstep':
+        bench_dstep(args, device)
+    elif args.bench == 'export':
+        bench_export(args)
+    elif args.bench == 'checkpoint':
+        bench_checkpoint(args, device)
+    elif args.bench == 'recaption':
+        bench_recaption(args, device)
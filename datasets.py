@@ -10,90 +10,183 @@ from miscc.config import cfg
 
 import torch
 import torch.utils.data as data
-from torch.autograd import Variable
+from torch.utils.data.dataloader import default_collate
 import torchvision.transforms as transforms
 
 import os
 import sys
+import itertools
+import threading
+import multiprocessing
 import numpy as np
 import pandas as pd
 from PIL import Image
 import numpy.random as random
 if sys.version_info[0] == 2:
     import cPickle as pickle
+    import Queue as queue
 else:
     import pickle
+    import queue
 
 
-def prepare_data(data):
-    imgs, captions, captions_lens, class_ids, keys, captions_2, captions_lens_2 = data
+def sort_data(data):
+    """Sorts a collated batch by caption length in a decreasing order.
+
+    Images are left in dataset order; prepare_batch moves them to the device
+    once and reorders them there for both caption sets.
+    """
+    imgs, captions, captions_lens, class_ids, keys, captions_2, captions_lens_2 = data[:7]
 
-    # sort data by the length in a decreasing order
     sorted_cap_lens, sorted_cap_indices = \
         torch.sort(captions_lens, 0, True)
-    
     sorted_cap_lens_2, sorted_cap_indices_2 = \
         torch.sort(captions_lens_2, 0, True)
 
-    imgs_2 = imgs.copy()
-
-    real_imgs = []
-    for i in range(len(imgs)):
-        imgs[i] = imgs[i][sorted_cap_indices]
-        if cfg.CUDA:
-            real_imgs.append(Variable(imgs[i]).cuda())
-        else:
-            real_imgs.append(Variable(imgs[i]))
-
-    real_imgs_2 = []
-    for i in range(len(imgs_2)):
-        imgs_2[i] = imgs_2[i][sorted_cap_indices_2]
-        if cfg.CUDA:
-            real_imgs_2.append(Variable(imgs_2[i]).cuda())
-        else:
-            real_imgs_2.append(Variable(imgs_2[i]))
+    captions = captions[sorted_cap_indices].squeeze(2)
+    captions_2 = captions_2[sorted_cap_indices_2].squeeze(2)
 
+    class_ids_1 = class_ids[sorted_cap_indices].numpy()
+    class_ids_2 = class_ids[sorted_cap_indices_2].numpy()
+    keys = [keys[i] for i in sorted_cap_indices.numpy()]
+    ret = [imgs, captions, sorted_cap_lens, class_ids_1, keys,
+           captions_2, sorted_cap_lens_2, class_ids_2,
+           sorted_cap_indices, sorted_cap_indices_2]
+
+    if len(data) > 7:
+        # cached text embeddings (cfg.TEXT.EMB_CACHE)
+        words_embs, sent_emb, words_embs_2, sent_emb_2 = data[7:]
+        ret += [words_embs[sorted_cap_indices], sent_emb[sorted_cap_indices],
+                words_embs_2[sorted_cap_indices_2], sent_emb_2[sorted_cap_indices_2]]
+    return ret
 
-    captions = captions[sorted_cap_indices].squeeze()
-    
-    captions_2 = captions_2[sorted_cap_indices_2].squeeze()
-    # sorted_captions_lens_2 = captions_lens_2[sorted_cap_indices].squeeze()
 
-    # captions = torch.cat([captions, captions_2], dim=0)
-    # sorted_cap_lens = torch.cat([sorted_cap_lens, sorted_captions_lens_2], dim=0)
+def collate_data(batch):
+    """DataLoader collate_fn producing length-sorted batches in the workers."""
+    return sort_data(default_collate(batch))
+
+
+def prepare_batch(data, device):
+    """Moves a collate_data batch to device.
+
+    Copies are non-blocking (the DataLoader should use pin_memory=True) and
+    the image tensor is transferred once, then indexed on the device for
+    both caption orders. Returns the same list as prepare_data, followed by
+    words_embs, sent_emb, words_embs_2, sent_emb_2 when the dataset serves
+    cached text embeddings.
+    """
+    imgs, captions, sorted_cap_lens, class_ids_1, keys, \
+        captions_2, sorted_cap_lens_2, class_ids_2, \
+        sorted_cap_indices, sorted_cap_indices_2 = data[:10]
+
+    sorted_cap_indices = sorted_cap_indices.to(device, non_blocking=True)
+    sorted_cap_indices_2 = sorted_cap_indices_2.to(device, non_blocking=True)
+
+    real_imgs, real_imgs_2 = [], []
+    for img in imgs:
+        img = img.to(device, non_blocking=True)
+        real_imgs.append(img[sorted_cap_indices])
+        real_imgs_2.append(img[sorted_cap_indices_2])
+
+    captions = captions.to(device, non_blocking=True)
+    sorted_cap_lens = sorted_cap_lens.to(device, non_blocking=True)
+    captions_2 = captions_2.to(device, non_blocking=True)
+    sorted_cap_lens_2 = sorted_cap_lens_2.to(device, non_blocking=True)
+
+    ret = [real_imgs, real_imgs_2, captions, sorted_cap_lens,
+           class_ids_1, keys, captions_2, sorted_cap_lens_2, class_ids_2,
+           sorted_cap_indices, sorted_cap_indices_2]
+    # cached words_embs, sent_emb, words_embs_2, sent_emb_2 are stored in fp16
+    for emb in data[10:]:
+        ret.append(emb.to(device, non_blocking=True).float())
+    return ret
 
 
-    
-    class_ids_1 = class_ids[sorted_cap_indices].numpy()
-    class_ids_2 = class_ids[sorted_cap_indices_2].numpy()
+def prepare_data(data):
+    device = torch.device('cuda' if cfg.CUDA else 'cpu')
+    return prepare_batch(sort_data(data), device)
 
-    
-    # sent_indices = sent_indices[sorted_cap_indices]
-    keys = [keys[i] for i in sorted_cap_indices.numpy()]
-    # print('keys', type(keys), keys[-1])  # list
-    if cfg.CUDA:
-        captions = Variable(captions).cuda()
-        sorted_cap_lens = Variable(sorted_cap_lens).cuda()
 
-        captions_2 = Variable(captions_2).cuda()
-        sorted_cap_lens_2 = Variable(sorted_cap_lens_2).cuda()
+def _batch_tensors(batch):
+    for item in batch:
+        if torch.is_tensor(item):
+            yield item
+        elif isinstance(item, list):
+            for t in item:
+                if torch.is_tensor(t):
+                    yield t
 
-        sorted_cap_indices = sorted_cap_indices.cuda()
-        sorted_cap_indices_2 = sorted_cap_indices_2.cuda()       
-        
-    else:
-        captions = Variable(captions)
-        sorted_cap_lens = Variable(sorted_cap_lens)
 
-        captions_2 = Variable(captions_2)
-        sorted_cap_lens_2 = Variable(sorted_cap_lens_2)
+class DataPrefetcher(object):
+    """Prepares batch N+1 while step N runs.
 
-    return [real_imgs, real_imgs_2, captions, sorted_cap_lens,
-            class_ids_1, keys, captions_2, sorted_cap_lens_2, class_ids_2, sorted_cap_indices, sorted_cap_indices_2]
+    Wraps a DataLoader built with collate_data. On CUDA the host-to-device
+    copies of the next batch are issued on a side stream; without CUDA a
+    background thread keeps a small queue of prepared batches. Iterating
+    yields the same list as prepare_batch.
+    """
 
+    def __init__(self, dataloader, device, queue_size=2):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.queue_size = queue_size
 
-def get_imgs(img_path, imsize, bbox=None,
-             transform=None, normalize=None):
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(device=self.device)
+        loader = iter(self.dataloader)
+
+        def preload():
+            try:
+                batch_cpu = next(loader)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return prepare_batch(batch_cpu, self.device)
+
+        batch = preload()
+        while batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            # the tensors were allocated on the side stream
+            for t in _batch_tensors(batch):
+                t.record_stream(current)
+            next_batch = preload()
+            yield batch
+            batch = next_batch
+
+    def _thread_iter(self):
+        batches = queue.Queue(maxsize=self.queue_size)
+        end = object()
+
+        def worker():
+            try:
+                for batch_cpu in self.dataloader:
+                    batches.put(prepare_batch(batch_cpu, self.device))
+                batches.put(end)
+            except Exception as e:
+                batches.put(e)
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        while True:
+            batch = batches.get()
+            if batch is end:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+
+def load_img(img_path, bbox=None):
     img = Image.open(img_path).convert('RGB')
     width, height = img.size
     if bbox is not None:
@@ -105,7 +198,10 @@ def get_imgs(img_path, imsize, bbox=None,
         x1 = np.maximum(0, center_x - r)
         x2 = np.minimum(width, center_x + r)
         img = img.crop([x1, y1, x2, y2])
+    return img
 
+
+def transform_imgs(img, imsize, transform=None, normalize=None):
     if transform is not None:
         img = transform(img)
 
@@ -124,6 +220,313 @@ def get_imgs(img_path, imsize, bbox=None,
     return ret
 
 
+def get_imgs(img_path, imsize, bbox=None,
+             transform=None, normalize=None):
+    img = load_img(img_path, bbox)
+    return transform_imgs(img, imsize, transform, normalize)
+
+
+def _load_resized(job):
+    img_path, bbox, size = job
+    img = transforms.Resize(size)(load_img(img_path, bbox))
+    return np.asarray(img, dtype=np.uint8)
+
+
+class ImageShards(object):
+    """Bbox-cropped, pre-resized uint8 RGB images in one flat pixel file.
+
+    <prefix>_pixels.u8 holds the HWC images back to back in dataset order and
+    <prefix>_index.npz the (N, 3) int64 array of [offset, height, width] plus
+    the resize size and image count it was built with.
+    Only the random crop and flip are left to do online.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._pixels = None
+        self._index = None
+
+    @staticmethod
+    def build(dataset, prefix, size, workers=1):
+        jobs = [dataset.img_path(i) + (size,) for i in range(len(dataset))]
+        index = np.zeros((len(jobs), 3), dtype=np.int64)
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(_load_resized, jobs, chunksize=16)
+        else:
+            pool = None
+            results = map(_load_resized, jobs)
+
+        offset = 0
+        with open(prefix + '_pixels.u8', 'wb') as f:
+            for i, img in enumerate(results):
+                f.write(img.tobytes())
+                index[i] = offset, img.shape[0], img.shape[1]
+                offset += img.size
+                if i % 1000 == 0:
+                    print('shard: %d/%d' % (i, len(jobs)))
+        if pool is not None:
+            pool.close()
+            pool.join()
+        np.savez(prefix + '_index.npz', index=index, size=size, count=len(jobs))
+        print('Save to: ', prefix + '_pixels.u8')
+        return ImageShards(prefix)
+
+    def exists(self):
+        return os.path.isfile(self.prefix + '_index.npz')
+
+    def is_stale(self, size, count):
+        if not self.exists():
+            return True
+        with np.load(self.prefix + '_index.npz') as meta:
+            return int(meta['size']) != size or int(meta['count']) != count
+
+    def _open(self):
+        if self._index is None:
+            self._pixels = np.memmap(self.prefix + '_pixels.u8',
+                                     dtype=np.uint8, mode='r')
+            with np.load(self.prefix + '_index.npz') as meta:
+                self._index = meta['index']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pixels'] = None
+        state['_index'] = None
+        return state
+
+    def __len__(self):
+        self._open()
+        return len(self._index)
+
+    def __getitem__(self, ix):
+        self._open()
+        offset, height, width = self._index[ix]
+        img = self._pixels[offset:offset + height * width * 3]
+        return Image.fromarray(np.asarray(img).reshape(height, width, 3))
+
+
+class CaptionStore(object):
+    """Captions as one flat int32 token array plus an offsets array.
+
+    Both arrays live in .npy files and are memory-mapped on first access, so
+    DataLoader workers share the pages instead of each unpickling its own
+    copy of the caption lists.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._tokens = None
+        self._offsets = None
+
+    @staticmethod
+    def build(captions, prefix):
+        lens = np.fromiter((len(c) for c in captions), dtype=np.int64,
+                           count=len(captions))
+        offsets = np.zeros(len(captions) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        tokens = np.fromiter(itertools.chain.from_iterable(captions),
+                             dtype=np.int32, count=int(offsets[-1]))
+        if (tokens == 0).sum() > 0:
+            print('ERROR: do not need END (0) token', prefix)
+        np.save(prefix + '_tokens.npy', tokens)
+        np.save(prefix + '_offsets.npy', offsets)
+        print('Save to: ', prefix + '_tokens.npy')
+        return CaptionStore(prefix)
+
+    def is_stale(self, source_path):
+        path = self.prefix + '_offsets.npy'
+        return not os.path.isfile(path) or \
+            os.path.getmtime(path) < os.path.getmtime(source_path)
+
+    def _open(self):
+        if self._offsets is None:
+            self._tokens = np.load(self.prefix + '_tokens.npy', mmap_mode='r')
+            self._offsets = np.load(self.prefix + '_offsets.npy', mmap_mode='r')
+
+    def __getstate__(self):
+        # workers re-open the mmap rather than receive a pickled copy
+        state = self.__dict__.copy()
+        state['_tokens'] = None
+        state['_offsets'] = None
+        return state
+
+    def __len__(self):
+        self._open()
+        return len(self._offsets) - 1
+
+    def __getitem__(self, ix):
+        self._open()
+        return np.asarray(self._tokens[self._offsets[ix]:self._offsets[ix + 1]])
+
+    def pad(self, indices, words_num, shuffle=True):
+        """Gather captions into a zero-padded (len(indices), words_num) block.
+
+        Captions longer than words_num keep a random sorted subset of their
+        words (or the first words_num when shuffle is False).
+        """
+        self._open()
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self._offsets[indices]
+        lens = self._offsets[indices + 1] - starts
+        cap_lens = np.minimum(lens, words_num)
+
+        cols = np.arange(words_num)
+        pos = starts[:, None] + cols[None, :]
+        if shuffle:
+            for r in np.flatnonzero(lens > words_num):
+                keep = np.sort(np.random.permutation(lens[r])[:words_num])
+                pos[r] = starts[r] + keep
+        valid = cols[None, :] < cap_lens[:, None]
+
+        # pad with 0s (i.e., '<end>')
+        x = np.zeros((len(indices), words_num), dtype='int64')
+        x[valid] = self._tokens[pos[valid]]
+        return x, cap_lens
+
+
+class EmbeddingStore(object):
+    """Frozen RNN_ENCODER outputs for every caption, keyed by caption index.
+
+    <prefix>_words.npy is (N, nef, WORDS_NUM) and <prefix>_sent.npy (N, nef),
+    both fp16 and memory-mapped. Captions are encoded with deterministic
+    truncation (CaptionStore.pad with shuffle=False). <prefix>_meta.npz
+    records the caption count, WORDS_NUM and text encoder of the build;
+    is_stale rejects the store when any of them or the captions changed.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._words = None
+        self._sent = None
+
+    def create(self, num, nef, words_num):
+        # an interrupted rebuild must not pass for the previous one
+        if os.path.isfile(self.prefix + '_meta.npz'):
+            os.remove(self.prefix + '_meta.npz')
+        words = np.lib.format.open_memmap(
+            self.prefix + '_words.npy', mode='w+', dtype=np.float16,
+            shape=(num, nef, words_num))
+        sent = np.lib.format.open_memmap(
+            self.prefix + '_sent.npy', mode='w+', dtype=np.float16,
+            shape=(num, nef))
+        return words, sent
+
+    def exists(self):
+        return os.path.isfile(self.prefix + '_sent.npy')
+
+    def write_meta(self, count, words_num, encoder):
+        np.savez(self.prefix + '_meta.npz', count=count, words_num=words_num,
+                 encoder=os.path.abspath(encoder))
+
+    def is_stale(self, count, words_num, encoder, source_path=None):
+        path = self.prefix + '_meta.npz'
+        if not self.exists() or not os.path.isfile(path):
+            return True
+        if source_path is not None and \
+                os.path.getmtime(path) < os.path.getmtime(source_path):
+            return True
+        with np.load(path) as meta:
+            return int(meta['count']) != count or \
+                int(meta['words_num']) != words_num or \
+                str(meta['encoder']) != os.path.abspath(encoder)
+
+    def _open(self):
+        if self._sent is None:
+            self._words = np.load(self.prefix + '_words.npy', mmap_mode='r')
+            self._sent = np.load(self.prefix + '_sent.npy', mmap_mode='r')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_words'] = None
+        state['_sent'] = None
+        return state
+
+    def __len__(self):
+        self._open()
+        return len(self._sent)
+
+    def lookup(self, indices):
+        self._open()
+        indices = np.asarray(indices, dtype=np.int64)
+        return self._words[indices], self._sent[indices]
+
+
+class FeatureStore(object):
+    """Real-image CNN_ENCODER outputs, keyed by dataset index.
+
+    <prefix>_regions.npy is (N, nef, 17, 17) and <prefix>_code.npy (N, nef),
+    both fp16 and memory-mapped. Written by preprocess.py --stage img_feats
+    so evaluation code does not rerun Inception-v3 over the real images.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._regions = None
+        self._code = None
+
+    def create(self, num, nef, att_sze=17):
+        # the cached statistics belong to the features being replaced
+        if os.path.isfile(self.prefix + '_stats.npz'):
+            os.remove(self.prefix + '_stats.npz')
+        regions = np.lib.format.open_memmap(
+            self.prefix + '_regions.npy', mode='w+', dtype=np.float16,
+            shape=(num, nef, att_sze, att_sze))
+        code = np.lib.format.open_memmap(
+            self.prefix + '_code.npy', mode='w+', dtype=np.float16,
+            shape=(num, nef))
+        return regions, code
+
+    def exists(self):
+        return os.path.isfile(self.prefix + '_code.npy')
+
+    def _open(self):
+        if self._code is None:
+            self._regions = np.load(self.prefix + '_regions.npy', mmap_mode='r')
+            self._code = np.load(self.prefix + '_code.npy', mmap_mode='r')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_regions'] = None
+        state['_code'] = None
+        return state
+
+    def __len__(self):
+        self._open()
+        return len(self._code)
+
+    def lookup(self, indices, device=None):
+        """Region features and cnn_code of the given images, as fp32 tensors."""
+        self._open()
+        indices = np.asarray(indices, dtype=np.int64)
+        regions = torch.from_numpy(np.asarray(self._regions[indices]))
+        code = torch.from_numpy(np.asarray(self._code[indices]))
+        if device is not None:
+            regions, code = regions.to(device), code.to(device)
+        return regions.float(), code.float()
+
+    def cnn_code(self, device=None):
+        """All sentence-level image codes, for R-precision and retrieval."""
+        self._open()
+        code = torch.from_numpy(np.asarray(self._code))
+        if device is not None:
+            code = code.to(device)
+        return code.float()
+
+    def stats(self):
+        """Mean and covariance of cnn_code (FID-style), cached in <prefix>_stats.npz."""
+        path = self.prefix + '_stats.npz'
+        if os.path.isfile(path) and \
+                os.path.getmtime(path) >= os.path.getmtime(self.prefix + '_code.npy'):
+            with np.load(path) as stats:
+                return stats['mu'], stats['sigma']
+        self._open()
+        code = np.asarray(self._code, dtype=np.float64)
+        mu = np.mean(code, axis=0)
+        sigma = np.cov(code, rowvar=False)
+        np.savez(path, mu=mu, sigma=sigma)
+        return mu, sigma
+
+
 class TextDataset(data.Dataset):
     def __init__(self, data_dir, split='train',
                  base_size=64,
@@ -142,6 +545,7 @@ class TextDataset(data.Dataset):
 
         self.data = []
         self.data_dir = data_dir
+        self.bbox_index = None
         if data_dir.find('birds') != -1:
             self.bbox = self.load_bbox()
         else:
@@ -154,30 +558,51 @@ class TextDataset(data.Dataset):
         self.class_id = self.load_class_id(split_dir, len(self.filenames))
         self.number_example = len(self.filenames)
 
+        self.shards = None
+        if cfg.IMG_SHARDS:
+            shards = ImageShards(self.shards_prefix(split))
+            if shards.is_stale(self.shards_size(), self.number_example):
+                raise IOError('%s_index.npz is missing or was built for another '
+                              'image size, run preprocess.py --stage shards '
+                              'first' % shards.prefix)
+            self.shards = shards
+
+        self.text_embs = None
+        if cfg.TEXT.EMB_CACHE:
+            text_embs = EmbeddingStore(os.path.join(split_dir, 'text_embs'))
+            if text_embs.is_stale(len(self.captions), cfg.TEXT.WORDS_NUM,
+                                  cfg.TEXT.DAMSM_NAME,
+                                  self.captions.prefix + '_offsets.npy'):
+                raise IOError('%s_meta.npz is missing or was built for other '
+                              'captions, TEXT.WORDS_NUM or TEXT.DAMSM_NAME, run '
+                              'preprocess.py --stage text_embs first' % text_embs.prefix)
+            self.text_embs = text_embs
+
     def load_bbox(self):
+        # returns an (N, 4) int array and fills self.bbox_index with the
+        # filename -> row mapping; cached next to captions.pickle
         data_dir = self.data_dir
-        bbox_path = os.path.join(data_dir, 'CUB_200_2011/bounding_boxes.txt')
-        df_bounding_boxes = pd.read_csv(bbox_path,
-                                        delim_whitespace=True,
-                                        header=None).astype(int)
-        #
-        filepath = os.path.join(data_dir, 'CUB_200_2011/images.txt')
-        df_filenames = \
-            pd.read_csv(filepath, delim_whitespace=True, header=None)
-        filenames = df_filenames[1].tolist()
-        print('Total filenames: ', len(filenames), filenames[0])
-        #
-        filename_bbox = {img_file[:-4]: [] for img_file in filenames}
-        numImgs = len(filenames)
-        # for i in xrange(0, numImgs):
-        for i in range(0, numImgs):
+        cache_path = os.path.join(data_dir, 'bounding_boxes.pickle')
+        if os.path.isfile(cache_path):
+            with open(cache_path, 'rb') as f:
+                keys, bboxes = pickle.load(f)
+            print('Load from: ', cache_path)
+        else:
+            bbox_path = os.path.join(data_dir, 'CUB_200_2011/bounding_boxes.txt')
             # bbox = [x-left, y-top, width, height]
-            bbox = df_bounding_boxes.iloc[i][1:].tolist()
-
-            key = filenames[i][:-4]
-            filename_bbox[key] = bbox
+            bboxes = pd.read_csv(bbox_path, sep=r'\s+',
+                                 header=None).values[:, 1:].astype(int)
+            #
+            filepath = os.path.join(data_dir, 'CUB_200_2011/images.txt')
+            filenames = pd.read_csv(filepath, sep=r'\s+', header=None)[1]
+            print('Total filenames: ', len(filenames), filenames[0])
+            keys = filenames.str.slice(stop=-4).tolist()
+            with open(cache_path, 'wb') as f:
+                pickle.dump([keys, bboxes], f, protocol=2)
+                print('Save to: ', cache_path)
         #
-        return filename_bbox
+        self.bbox_index = {key: i for i, key in enumerate(keys)}
+        return bboxes
 
     def load_captions(self, data_dir, filenames):
         all_captions = []
@@ -283,7 +708,12 @@ class TextDataset(data.Dataset):
         else:  # split=='test'
             captions = test_captions
             filenames = test_names
-        return filenames, captions, ixtoword, wordtoix, n_words
+
+        store = CaptionStore(os.path.join(data_dir, split, 'captions'))
+        if store.is_stale(filepath):
+            store = CaptionStore.build(captions, store.prefix)
+        del train_captions, test_captions, captions
+        return filenames, store, ixtoword, wordtoix, n_words
 
     def load_class_id(self, data_dir, total_num):
         if os.path.isfile(data_dir + '/class_info.pickle'):
@@ -304,53 +734,52 @@ class TextDataset(data.Dataset):
             filenames = []
         return filenames
 
-    def get_caption(self, sent_ix):
-        # a list of indices for a sentence
-        sent_caption = np.asarray(self.captions[sent_ix]).astype('int64')
-        if (sent_caption == 0).sum() > 0:
-            print('ERROR: do not need END (0) token', sent_caption)
-        num_words = len(sent_caption)
-        # pad with 0s (i.e., '<end>')
-        x = np.zeros((cfg.TEXT.WORDS_NUM, 1), dtype='int64')
-        x_len = num_words
-        if num_words <= cfg.TEXT.WORDS_NUM:
-            x[:num_words, 0] = sent_caption
-        else:
-            ix = list(np.arange(num_words))  # 1, 2, 3,..., maxNum
-            np.random.shuffle(ix)
-            ix = ix[:cfg.TEXT.WORDS_NUM]
-            ix = np.sort(ix)
-            x[:, 0] = sent_caption[ix]
-            x_len = cfg.TEXT.WORDS_NUM
-        return x, x_len
+    def shards_size(self):
+        # shards store images resized the way the online Resize would
+        return int(self.imsize[-1] * 76 / 64)
 
-    def __getitem__(self, index):
-        #
+    def shards_prefix(self, split):
+        return os.path.join(self.data_dir, split, 'images_%d' % self.shards_size())
+
+    def img_path(self, index):
         key = self.filenames[index]
-        cls_id = self.class_id[index]
-        #
         if self.bbox is not None:
-            bbox = self.bbox[key]
+            bbox = self.bbox[self.bbox_index[key]]
             data_dir = '%s/CUB_200_2011' % self.data_dir
         else:
             bbox = None
             data_dir = self.data_dir
+        return '%s/images/%s.jpg' % (data_dir, key), bbox
+
+    def get_caption(self, sent_ix):
+        x, x_len = self.captions.pad([sent_ix], cfg.TEXT.WORDS_NUM)
+        return x.reshape(-1, 1), int(x_len[0])
+
+    def __getitem__(self, index):
         #
-        img_name = '%s/images/%s.jpg' % (data_dir, key)
-        imgs = get_imgs(img_name, self.imsize,
-                        bbox, self.transform, normalize=self.norm)
-        # random select a sentence
-        sent_ix = random.randint(0, self.embeddings_num)
-        new_sent_ix = index * self.embeddings_num + sent_ix
-        caps, cap_len = self.get_caption(new_sent_ix)
-        
-        # second sentence
-        sent_ix = random.randint(0, self.embeddings_num)
+        key = self.filenames[index]
+        cls_id = self.class_id[index]
+        #
+        if self.shards is not None:
+            imgs = transform_imgs(self.shards[index], self.imsize,
+                                  self.transform, normalize=self.norm)
+        else:
+            img_name, bbox = self.img_path(index)
+            imgs = get_imgs(img_name, self.imsize,
+                            bbox, self.transform, normalize=self.norm)
+        # random select two sentences and pad them in one go
+        sent_ix = random.randint(0, self.embeddings_num, size=2)
         new_sent_ix = index * self.embeddings_num + sent_ix
-        caps_two, cap_len_two = self.get_caption(new_sent_ix)
-        
-        
-        return imgs, caps, cap_len, cls_id, key, caps_two, cap_len_two
+        # cached embeddings were computed without random word dropping
+        caps, cap_lens = self.captions.pad(new_sent_ix, cfg.TEXT.WORDS_NUM,
+                                           shuffle=self.text_embs is None)
+
+        ret = [imgs, caps[0][:, None], int(cap_lens[0]), cls_id, key,
+               caps[1][:, None], int(cap_lens[1])]
+        if self.text_embs is not None:
+            words_embs, sent_emb = self.text_embs.lookup(new_sent_ix)
+            ret += [words_embs[0], sent_emb[0], words_embs[1], sent_emb[1]]
+        return ret
 
     def get_mis_caption(self, cls_id):
         mis_match_captions_t = []
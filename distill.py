@@ -0,0 +1,196 @@
+# -*- encoding: utf-8 -*-
+"""Distill light auxiliary models from trained SSA-GAN networks.
+
+--stage preview trains the PreviewHeads of NetG, --stage caption a cheaper
+image encoder for the recaption loss (CAP.BACKBONE).
+
+    python distill.py --cfg cfg/bird.yml --stage preview|caption
+"""
+from __future__ import print_function
+
+import os
+import sys
+import pprint
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+from miscc.config import cfg, cfg_from_file
+from datasets import TextDataset
+from DAMSM import RNN_ENCODER, CNN_ENCODER
+from model import NetG, PreviewHeads, CAPTION_CNN, caption_encoder
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Distill auxiliary models for SSA-GAN')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file',
+                        default='cfg/bird.yml', type=str)
+    parser.add_argument('--data_dir', dest='data_dir', type=str, default='')
+    parser.add_argument('--stage', dest='stage', type=str, default='preview',
+                        choices=['preview', 'caption'])
+    parser.add_argument('--backbone', dest='backbone', type=str, default='inception',
+                        choices=['inception', 'distilled'],
+                        help='caption encoder to distill with --stage caption')
+    parser.add_argument('--workers', dest='workers', type=int, default=4)
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=16)
+    parser.add_argument('--steps', dest='steps', type=int, default=20000)
+    parser.add_argument('--lr', dest='lr', type=float, default=2e-4)
+    args = parser.parse_args()
+    return args
+
+
+def load_netG(device):
+    netG = NetG(cfg.TRAIN.NF, 100)
+    state_dict = torch.load(cfg.TRAIN.NET_G, map_location=lambda storage, loc: storage)
+    # checkpoints of main.py are saved from the DataParallel wrapper
+    netG.load_state_dict({k[7:] if k.startswith('module.') else k: v
+                          for k, v in state_dict.items()})
+    for p in netG.parameters():
+        p.requires_grad = False
+    return netG.to(device).eval()
+
+
+def load_text_encoder(n_words, device):
+    text_encoder = RNN_ENCODER(n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
+    state_dict = torch.load(cfg.TEXT.DAMSM_NAME, map_location=lambda storage, loc: storage)
+    text_encoder.load_state_dict(state_dict)
+    for p in text_encoder.parameters():
+        p.requires_grad = False
+    return text_encoder.to(device).eval()
+
+
+def sample_sent_emb(dataset, text_encoder, batch_size, device):
+    """Sentence embeddings of randomly drawn training captions."""
+    caps, cap_lens = dataset.captions.pad(
+        np.random.randint(0, len(dataset.captions), size=batch_size),
+        cfg.TEXT.WORDS_NUM, shuffle=False)
+    caps, cap_lens = torch.from_numpy(caps), torch.from_numpy(cap_lens)
+    # the encoder packs its input; the order of the batch does not matter here
+    cap_lens, sorted_cap_indices = torch.sort(cap_lens, 0, True)
+    hidden = text_encoder.init_hidden(batch_size)
+    _, sent_emb = text_encoder(caps[sorted_cap_indices].to(device), cap_lens.to(device), hidden)
+    return sent_emb
+
+
+def distill_preview(args, device):
+    """Train the PreviewHeads to match the downsampled full NetG output."""
+    dataset = TextDataset(cfg.DATA_DIR, 'train', base_size=cfg.TREE.BASE_SIZE)
+    text_encoder = load_text_encoder(dataset.n_words, device)
+    netG = load_netG(device)
+    heads = PreviewHeads(cfg.TRAIN.NF).to(device)
+    optimizer = torch.optim.Adam(heads.parameters(), lr=args.lr, betas=(0.5, 0.999))
+
+    for step in range(args.steps):
+        with torch.no_grad():
+            sent_emb = sample_sent_emb(dataset, text_encoder, args.batch_size, device)
+            noise = torch.randn(args.batch_size, 100, device=device)
+            modulation = netG.condition(sent_emb)
+            feat64, state = netG.preview(noise, modulation, None, 64)
+            feat128, state = netG.refine(state, modulation, size=128)
+            fake, _ = netG.refine(state, modulation)
+
+        loss = 0
+        for size, feat in ((64, feat64), (128, feat128)):
+            target = F.interpolate(fake, size=(size, size), mode='area')
+            loss = loss + F.l1_loss(heads(feat, size), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if step % 500 == 0:
+            print('preview: step %d/%d, l1 %.4f' % (step, args.steps, loss.item()))
+
+    save_path = cfg.TRAIN.NET_G.replace('.pth', '_preview.pth')
+    torch.save(heads.state_dict(), save_path)
+    print('Save to: ', save_path)
+
+
+def load_image_encoder(device):
+    image_encoder = CNN_ENCODER(cfg.TEXT.EMBEDDING_DIM)
+    img_encoder_path = cfg.TEXT.DAMSM_NAME.replace('text_encoder', 'image_encoder')
+    state_dict = torch.load(img_encoder_path, map_location=lambda storage, loc: storage)
+    image_encoder.load_state_dict(state_dict)
+    for p in image_encoder.parameters():
+        p.requires_grad = False
+    return image_encoder.to(device).eval()
+
+
+def distill_caption(args, device):
+    """Train a cheaper recaption image encoder to match CAPTION_CNN.
+
+    'inception' fits CAPTION_HEAD on the pooled CNN_ENCODER features,
+    'distilled' fits the whole CAPTION_CNN_LITE, both with an MSE to the
+    ResNet-152 caption features of the same training images.
+    """
+    imsize = cfg.TREE.BASE_SIZE
+    image_transform = transforms.Compose([
+        transforms.Resize(int(imsize * 76 / 64)),
+        transforms.RandomCrop(imsize),
+        transforms.RandomHorizontalFlip()])
+    if cfg.IMG_SHARDS:
+        image_transform = transforms.Compose([
+            transforms.RandomCrop(imsize),
+            transforms.RandomHorizontalFlip()])
+    cfg.TEXT.EMB_CACHE = False
+    dataset = TextDataset(cfg.DATA_DIR, 'train', base_size=imsize,
+                          transform=image_transform)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, drop_last=True, shuffle=True,
+        num_workers=args.workers, pin_memory=cfg.CUDA)
+
+    teacher = CAPTION_CNN(cfg.CAP.embed_size)
+    teacher.load_state_dict(torch.load(cfg.CAP.caption_cnn_path,
+                                       map_location=lambda storage, loc: storage))
+    for p in teacher.parameters():
+        p.requires_grad = False
+    teacher = teacher.to(device).eval()
+    image_encoder = load_image_encoder(device) if args.backbone == 'inception' else None
+
+    student = caption_encoder(args.backbone, cfg.CAP.embed_size).to(device).train()
+    optimizer = torch.optim.Adam(student.parameters(), lr=args.lr)
+
+    step = 0
+    while step < args.steps:
+        for data in dataloader:
+            imgs = data[0][-1].to(device, non_blocking=True)
+            with torch.no_grad():
+                target = teacher(imgs)
+                if image_encoder is not None:
+                    _, _, imgs = image_encoder(imgs, return_pooled=True)
+            loss = F.mse_loss(student(imgs), target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if step % 500 == 0:
+                print('caption (%s): step %d/%d, mse %.4f' % (args.backbone, step, args.steps, loss.item()))
+            step += 1
+            if step >= args.steps:
+                break
+
+    s_tmp = cfg.CAP.caption_cnn_path
+    save_path = '%s_%s.pth' % (s_tmp[:s_tmp.rfind('.')], args.backbone)
+    torch.save(student.state_dict(), save_path)
+    print('Save to: ', save_path)
+    print('Set CAP.BACKBONE: %s and CAP.backbone_path to use it.' % args.backbone)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.data_dir != '':
+        cfg.DATA_DIR = args.data_dir
+    print('Using config:')
+    pprint.pprint(cfg)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if args.stage == 'preview':
+        distill_preview(args, device)
+    elif args.stage == 'caption':
+        distill_caption(args, device)
@@ -37,15 +37,16 @@ import matplotlib.pyplot as plt
 
 from miscc.utils import mkdir_p
 from miscc.utils import imagenet_deprocess_batch
+from miscc.utils import autocast, grad_scaler, scaled_step
 from miscc.config import cfg, cfg_from_file
-from miscc.losses import DAMSM_loss,recaption_loss
+from miscc.losses import DAMSM_loss,recaption_loss,class_masks,magp_loss
 from sync_batchnorm import DataParallelWithCallback
 #from datasets_everycap import TextDataset
 from datasets import TextDataset
-from datasets import prepare_data
+from datasets import collate_data, prepare_batch, DataPrefetcher
 from DAMSM import RNN_ENCODER, CNN_ENCODER
-from model import NetG, NetD,CAPTION_CNN,CAPTION_RNN
-from nt_xent import NT_Xent
+from model import NetG, NetD,CAPTION_RNN,ConditionCache,caption_encoder
+from nt_xent import NT_Xent, NegativeQueue
 
 
 dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
@@ -122,8 +123,9 @@ def sampling(text_encoder,image_encoder,dataset, netG, dataloader, ixtoword, dev
 
             # real_imgs, real_imgs_2, captions, sorted_cap_lens,
             # class_ids_1, keys, captions_2, sorted_cap_lens_2, class_ids_2, sorted_cap_indices, sorted_cap_indices_2
+            data = prepare_batch(data, device)
             imags, imgs_2, captions, cap_lens, class_ids, keys, captions_2, cap_lens_2, class_ids_2, \
-                sort_ind, sort_ind_2 = prepare_data(data) 
+                sort_ind, sort_ind_2 = data[:11]
             # imags, captions, cap_lens, class_ids, keys = prepare_data(data)
             real_imgs = imags[0].to(device)
             cnt += batch_size
@@ -131,11 +133,15 @@ def sampling(text_encoder,image_encoder,dataset, netG, dataloader, ixtoword, dev
                 print('step: ', step)
             # if step > 50:
             #     break
-            hidden = text_encoder.init_hidden(batch_size)
-            # words_embs: batch_size x nef x seq_len
-            # sent_emb: batch_size x nef
-            words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
-            words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
+            if cfg.TEXT.EMB_CACHE:
+                # embeddings of the frozen text encoder come with the batch
+                words_embs, sent_emb = data[11:13]
+            else:
+                hidden = text_encoder.init_hidden(batch_size)
+                # words_embs: batch_size x nef x seq_len
+                # sent_emb: batch_size x nef
+                words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
+                words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
 
             # code for generating captions
             #cap_imgs = cap2img_new(ixtoword, captions, cap_lens, s_tmp_dir)
@@ -146,7 +152,7 @@ def sampling(text_encoder,image_encoder,dataset, netG, dataloader, ixtoword, dev
             with torch.no_grad():
                 noise = torch.randn(batch_size, 100)
                 noise = noise.to(device)
-                fake_imgs, stage_masks = netG(noise, sent_emb)
+                fake_imgs, stage_masks = netG(noise, sent_emb, return_masks=[6])
                 stage_mask = stage_masks[-1]
             for j in range(batch_size):
                 # save generated image
@@ -277,11 +283,8 @@ def gen_sample(text_encoder, netG, device, wordtoix):
     cap_len = []
     for i in captions:
         cap_len.append(len(i))
-    cap_len.sort(reverse=True)
     print(cap_len)
 
-    caps_lens = torch.tensor(cap_len, dtype=torch.int64).to(device)
-
     model_dir = cfg.TRAIN.NET_G
     split_dir = 'examples'
     netG.load_state_dict(torch.load(model_dir))
@@ -292,11 +295,13 @@ def gen_sample(text_encoder, netG, device, wordtoix):
     fake_img_save_dir = '%s/%s' % (s_tmp, split_dir)
     mkdir_p(fake_img_save_dir)
 
-    for step in range(50):
+    # the captions are fixed, so the text encoder and the modulation MLPs
+    # run once; every step below only pays for the synthesis
+    cond_cache = ConditionCache(text_encoder, netG)
+    condition = cond_cache.batch(caps, cap_len)
+    netG_module = getattr(netG, 'module', netG)
 
-        hidden = text_encoder.init_hidden(batch_size)
-        words_embs, sent_emb = text_encoder(caps, caps_lens, hidden)
-        words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
+    for step in range(50):
 
         #######################################################
         # (2) Generate fake images
@@ -311,7 +316,7 @@ def gen_sample(text_encoder, netG, device, wordtoix):
             noise = torch.cat(noise,0)
             
             noise = noise.to(device)
-            fake_imgs, stage_masks = netG(noise, sent_emb)
+            fake_imgs, stage_masks = netG_module.synthesize(noise, condition, return_masks=[6])
             stage_mask = stage_masks[-1]
         for j in range(batch_size):
             # save generated image
@@ -431,15 +436,13 @@ def train(dataloader, ixtoword, netG, netD, text_encoder, image_encoder,caption_
 
     gen_iterations = 0
 
-    mask = torch.ones((batch_size * 2, batch_size * 2), dtype=bool)
-    mask = mask.fill_diagonal_(0)
-    for i in range(batch_size):
-        mask[i, batch_size + i] = 0
-        mask[batch_size + i, i] = 0
-
     temperature = 0.5
-    device = noise.get_device()
-    criterion = NT_Xent(batch_size, temperature, mask, device)
+    criterion = NT_Xent(temperature)
+    # past cnn_code embeddings as extra negatives of the contrastive loss
+    queue = None
+    if cfg.TRAIN.QUEUE_SIZE > 0:
+        queue = NegativeQueue(cfg.TRAIN.QUEUE_SIZE, cfg.TEXT.EMBEDDING_DIM,
+                              cfg.TRAIN.QUEUE_MAX_AGE).to(device)
     # Build and load the generator and discriminator
     print("restoring: ", cfg.RESTORE)
     if cfg.RESTORE:
@@ -447,6 +450,9 @@ def train(dataloader, ixtoword, netG, netD, text_encoder, image_encoder,caption_
         netG.load_state_dict(torch.load(model_dir))
         model_dir_D = model_dir.replace('netG', 'netD')
         netD.load_state_dict(torch.load(model_dir_D))
+        model_dir_queue = model_dir.replace('netG', 'queue')
+        if queue is not None and os.path.isfile(model_dir_queue):
+            queue.load_state_dict(torch.load(model_dir_queue, map_location=lambda storage, loc: storage))
         netG.train()
         netD.train()
         istart = cfg.TRAIN.NET_G.rfind('_') + 1
@@ -458,133 +464,161 @@ def train(dataloader, ixtoword, netG, netD, text_encoder, image_encoder,caption_
     print('# param in net D is ',sum(p.numel() for p in netD.parameters() if p.requires_grad))
     print(".................................")
 
+    # loss scaling of the fp16 TRAIN.AMP mode, pass-through otherwise
+    scalerD = grad_scaler(device)
+    scalerG = grad_scaler(device)
+
+    # batch N+1 is collated and copied to the device while step N runs
+    prefetcher = DataPrefetcher(dataloader, device)
     for epoch in tqdm(range(state_epoch + 1, cfg.TRAIN.MAX_EPOCH + 1)):
-        data_iter = iter(dataloader)
         # for step, data in enumerate(dataloader, 0):
-        for step in tqdm(range(len(data_iter))):
-            data = data_iter.next()
-
+        for step, data in enumerate(tqdm(prefetcher)):
             imgs, imgs_2, captions, cap_lens, class_ids, keys, captions_2, cap_lens_2, class_ids_2, \
-                sort_ind, sort_ind_2 = prepare_data(data)   
+                sort_ind, sort_ind_2 = data[:11]
+
+            if cfg.TEXT.EMB_CACHE:
+                # embeddings of the frozen text encoder come with the batch
+                words_embs, sent_emb, words_embs_2, sent_emb_2 = data[11:]
+            else:
+                hidden = text_encoder.init_hidden(batch_size)
 
-            hidden = text_encoder.init_hidden(batch_size)
+                # words_embs: batch_size x nef x seq_len
+                # sent_emb: batch_size x nef
+                words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
+                words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
+
+                words_embs_2, sent_emb_2 = text_encoder(captions_2, cap_lens_2, hidden)
+                words_embs_2, sent_emb_2 = words_embs_2.detach(), sent_emb_2.detach()
+
+            # same-class mis-match mask, built once and reused by both
+            # DAMSM branches; the second caption order only permutes it
+            _, ori_indices = torch.sort(sort_ind, 0)
+            _, ori_indices_2 = torch.sort(sort_ind_2, 0)
+            perm_2 = ori_indices[sort_ind_2]
+            class_mask = class_masks(class_ids, sort_ind.device)
+            class_mask_2 = class_mask[perm_2][:, perm_2]
 
-            # words_embs: batch_size x nef x seq_len
-            # sent_emb: batch_size x nef
-            words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
-            words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
             mask = (captions == 0)
             num_words = words_embs.size(2)
             if mask.size(1) > num_words:
                 mask = mask[:, :num_words]
 
-            words_embs_2, sent_emb_2 = text_encoder(captions_2, cap_lens_2, hidden)
-            words_embs_2, sent_emb_2 = words_embs_2.detach(), sent_emb_2.detach()
             mask_2 = (captions_2 == 0)
             num_words_2 = words_embs_2.size(2)
             if mask_2.size(1) > num_words_2:
                 mask_2 = mask_2[:, :num_words_2]
 
             imgs = imgs[0].to(device)
-            real_features = netD(imgs)
-            output = netD.module.COND_DNET(real_features, sent_emb)
-            errD_real = torch.nn.ReLU()(1.0 - output).mean()
-
-            output = netD.module.COND_DNET(real_features[:(batch_size - 1)], sent_emb[1:batch_size])
-            errD_mismatch = torch.nn.ReLU()(1.0 + output).mean()
-
-            imgs_2 = imgs_2[0].to(device)
-            real_features_2 = netD(imgs_2)
-            output_2 = netD.module.COND_DNET(real_features_2, sent_emb_2)
-            errD_real_2 = torch.nn.ReLU()(1.0 - output_2).mean()
-
-            output_2 = netD.module.COND_DNET(real_features_2[:(batch_size - 1)], sent_emb_2[1:batch_size])
-            errD_mismatch_2 = torch.nn.ReLU()(1.0 + output_2).mean()
+            # MA-GP on this step, in its own update or folded into the hinge one
+            use_gp = step % cfg.TRAIN.MAGP_INTERVAL == 0
+            joint_gp = use_gp and cfg.TRAIN.MAGP_MODE == 'joint'
+            gp_weight = 2.0 * cfg.TRAIN.MAGP_INTERVAL
+            sent_real = sent_emb
+            if joint_gp:
+                # track the real forward so the penalty reuses its graph
+                imgs = imgs.data.requires_grad_()
+                sent_real = sent_emb.data.requires_grad_()
+            with autocast(device):
+                real_features = netD(imgs)
+                out_real = netD.module.COND_DNET(real_features, sent_real)
+                errD_real = torch.nn.ReLU()(1.0 - out_real).mean()
+
+                output = netD.module.COND_DNET(real_features[:(batch_size - 1)], sent_emb[1:batch_size])
+                errD_mismatch = torch.nn.ReLU()(1.0 + output).mean()
+
+                if cfg.TRAIN.SHARE_REAL_D:
+                    # imgs_2 only reorders imgs and NetD has no batch statistics,
+                    # so permuting the features gives the same result
+                    real_features_2 = real_features[perm_2]
+                else:
+                    imgs_2 = imgs_2[0].to(device)
+                    real_features_2 = netD(imgs_2)
+                output_2 = netD.module.COND_DNET(real_features_2, sent_emb_2)
+                errD_real_2 = torch.nn.ReLU()(1.0 - output_2).mean()
+
+                output_2 = netD.module.COND_DNET(real_features_2[:(batch_size - 1)], sent_emb_2[1:batch_size])
+                errD_mismatch_2 = torch.nn.ReLU()(1.0 + output_2).mean()
+
+                # synthesize fake images
+                noise = torch.randn(batch_size, 100)
+                noise = noise.to(device)
+                fake = netG(noise, sent_emb, return_masks=False)
+                fake_2 = netG(noise, sent_emb_2, return_masks=False)
 
-            # synthesize fake images
-            noise = torch.randn(batch_size, 100)
-            noise = noise.to(device)
-            fake, _ = netG(noise, sent_emb)
-            fake_2, _ = netG(noise, sent_emb_2)
+                # both caption branches go through each network in one batch
+                fakes = torch.cat((fake, fake_2), 0)
 
-            # G does not need update with D
-            fake_features = netD(fake.detach())
-            fake_features_2 = netD(fake_2.detach())
+                # G does not need update with D
+                fake_features, fake_features_2 = netD(fakes.detach()).split(batch_size)
 
-            errD_fake = netD.module.COND_DNET(fake_features, sent_emb)
-            errD_fake = torch.nn.ReLU()(1.0 + errD_fake).mean()
+                errD_fake = netD.module.COND_DNET(fake_features, sent_emb)
+                errD_fake = torch.nn.ReLU()(1.0 + errD_fake).mean()
 
-            errD_fake_2 = netD.module.COND_DNET(fake_features_2, sent_emb)
-            errD_fake_2 = torch.nn.ReLU()(1.0 + errD_fake_2).mean()
+                errD_fake_2 = netD.module.COND_DNET(fake_features_2, sent_emb)
+                errD_fake_2 = torch.nn.ReLU()(1.0 + errD_fake_2).mean()
 
-            errD = errD_real + (errD_fake + errD_mismatch) / 2.0
-            errD_2 = errD_real_2 + (errD_fake_2 + errD_mismatch_2) / 2.0
+                errD = errD_real + (errD_fake + errD_mismatch) / 2.0
+                errD_2 = errD_real_2 + (errD_fake_2 + errD_mismatch_2) / 2.0
 
-            errD += errD_2
+                errD += errD_2
 
-            optimizerD.zero_grad()
-            errD.backward()
-            optimizerD.step()
+                if joint_gp:
+                    d_loss = gp_weight * magp_loss(netD, imgs, sent_real, out_real, scalerD)
+                    errD_total = errD + d_loss
+                else:
+                    errD_total = errD
+            scaled_step(scalerD, optimizerD, errD_total)
 
             # MA-GP
-            interpolated = (imgs.data).requires_grad_()
-            sent_inter = (sent_emb.data).requires_grad_()
-            features = netD(interpolated)
-            out = netD.module.COND_DNET(features, sent_inter)
-            grads = torch.autograd.grad(outputs=out,
-                                        inputs=(interpolated, sent_inter),
-                                        grad_outputs=torch.ones(out.size()).cuda(),
-                                        retain_graph=True,
-                                        create_graph=True,
-                                        only_inputs=True)
-            grad0 = grads[0].view(grads[0].size(0), -1)
-            grad1 = grads[1].view(grads[1].size(0), -1)
-            grad = torch.cat((grad0, grad1), dim=1)
-            grad_l2norm = torch.sqrt(torch.sum(grad ** 2, dim=1))
-            d_loss_gp = torch.mean((grad_l2norm) ** 6)
-            d_loss = 2.0 * d_loss_gp
-            optimizerD.zero_grad()
-            d_loss.backward()
-            optimizerD.step()
+            if use_gp and not joint_gp:
+                with autocast(device):
+                    d_loss = gp_weight * magp_loss(netD, imgs, sent_emb, scaler=scalerD)
+                scaled_step(scalerD, optimizerD, d_loss)
 
             # update G
-            features = netD(fake)
-            features_2 = netD(fake_2)
-            output = netD.module.COND_DNET(features, sent_emb)
-            output_2 = netD.module.COND_DNET(features_2, sent_emb_2)
-            errG = - output.mean()
-            errG = - output_2.mean()
-            DAMSM = 0.05 * ( DAMSM_loss(image_encoder, fake, real_labels, words_embs,
-                                      sent_emb, match_labels, cap_lens, class_ids) \
-                            +  DAMSM_loss(image_encoder, fake_2, real_labels_2, words_embs_2,
-                                      sent_emb_2, match_labels_2, cap_lens_2, class_ids_2))
-            
-            _, ori_indices = torch.sort(sort_ind, 0)
-            _, ori_indices_2 = torch.sort(sort_ind_2, 0)
-
-            total_contra_loss = 0
-            i = -1
-            _, cnn_code = image_encoder(fake)
-            _, cnn_code_2 = image_encoder(fake_2)
-            cnn_code = cnn_code[ori_indices]
-            cnn_code_2 = cnn_code_2[ori_indices_2]
-
-            cnn_code = l2norm(cnn_code, dim=1)
-            cnn_code_2 = l2norm(cnn_code_2, dim=1)
-
-            contrative_loss = criterion(cnn_code, cnn_code_2)
-            total_contra_loss += contrative_loss *  0.2
-
-            ##### RECAPTION LOSS#############
-            cap_loss1=recaption_loss(caption_cnn,caption_rnn,fake,captions,cap_lens,device)
-            cap_loss2=recaption_loss(caption_cnn,caption_rnn,fake_2,captions_2,cap_lens_2,device)
-
-            cap_loss=(cap_loss1+cap_loss2)/2.0
-
-            errG_total = errG + DAMSM + total_contra_loss+cap_loss
-            optimizerG.zero_grad()
-            errG_total.backward()
-            optimizerG.step()
+            with autocast(device):
+                features, features_2 = netD(fakes).split(batch_size)
+                output = netD.module.COND_DNET(features, sent_emb)
+                output_2 = netD.module.COND_DNET(features_2, sent_emb_2)
+                errG = - output.mean()
+                errG = - output_2.mean()
+
+                # Inception features shared by DAMSM and the contrastive loss
+                region_features, cnn_code, pooled = image_encoder(fakes, return_pooled=True)
+                region_features, region_features_2 = region_features.split(batch_size)
+                cnn_code, cnn_code_2 = cnn_code.split(batch_size)
+                DAMSM = 0.05 * ( DAMSM_loss(image_encoder, fake, real_labels, words_embs,
+                                          sent_emb, match_labels, cap_lens, class_ids, class_mask,
+                                          region_features, cnn_code) \
+                                +  DAMSM_loss(image_encoder, fake_2, real_labels_2, words_embs_2,
+                                          sent_emb_2, match_labels_2, cap_lens_2, class_ids_2, class_mask_2,
+                                          region_features_2, cnn_code_2))
+
+                total_contra_loss = 0
+                i = -1
+                cnn_code = cnn_code[ori_indices]
+                cnn_code_2 = cnn_code_2[ori_indices_2]
+
+                cnn_code = l2norm(cnn_code, dim=1)
+                cnn_code_2 = l2norm(cnn_code_2, dim=1)
+
+                contrative_loss = criterion(cnn_code, cnn_code_2, queue)
+                total_contra_loss += contrative_loss *  0.2
+
+                ##### RECAPTION LOSS#############
+                # the 'inception' caption head reuses the image_encoder trunk
+                caption_input = pooled if cfg.CAP.BACKBONE == 'inception' else fakes
+                fakeimg_feature, fakeimg_feature_2 = caption_cnn(caption_input).split(batch_size)
+                cap_loss1=recaption_loss(caption_cnn,caption_rnn,fake,captions,cap_lens,device,fakeimg_feature)
+                cap_loss2=recaption_loss(caption_cnn,caption_rnn,fake_2,captions_2,cap_lens_2,device,fakeimg_feature_2)
+
+                cap_loss=(cap_loss1+cap_loss2)/2.0
+
+                errG_total = errG + DAMSM + total_contra_loss+cap_loss
+            scaled_step(scalerG, optimizerG, errG_total)
+            # only after backward: the loss graph reads the queue contents
+            if queue is not None:
+                queue.enqueue(torch.cat((cnn_code, cnn_code_2), 0))
 
         # caption can be converted to image and shown in tensorboard
         #cap_imgs = cap2img(ixtoword, captions, cap_lens)
@@ -595,6 +629,8 @@ def train(dataloader, ixtoword, netG, netD, text_encoder, image_encoder,caption_
             torch.save(netG.state_dict(), '%s/models/netG_%03d.pth' % (base_dir, epoch))
         if (epoch >= cfg.TRAIN.WARMUP_EPOCHS) and (epoch % cfg.TRAIN.DSAVE_INTERVAL == 0):
             torch.save(netD.state_dict(), '%s/models/netD_%03d.pth' % (base_dir, epoch))
+            if queue is not None:
+                torch.save(queue.state_dict(), '%s/models/queue_%03d.pth' % (base_dir, epoch))
 
 
 if __name__ == "__main__":
@@ -642,6 +678,11 @@ if __name__ == "__main__":
         transforms.Resize(int(imsize * 76 / 64)),
         transforms.RandomCrop(imsize),
         transforms.RandomHorizontalFlip()])
+    if cfg.IMG_SHARDS:
+        # shard images are already cropped and resized offline
+        image_transform = transforms.Compose([
+            transforms.RandomCrop(imsize),
+            transforms.RandomHorizontalFlip()])
     if cfg.B_VALIDATION:
         dataset = TextDataset(cfg.DATA_DIR, 'test',
                               base_size=cfg.TREE.BASE_SIZE,
@@ -652,7 +693,8 @@ if __name__ == "__main__":
         assert dataset
         dataloader = torch.utils.data.DataLoader(
             dataset, batch_size=batch_size, drop_last=True,
-            shuffle=True, num_workers=int(cfg.WORKERS))
+            shuffle=True, num_workers=int(cfg.WORKERS),
+            collate_fn=collate_data, pin_memory=cfg.CUDA)
     else:
         dataset = TextDataset(cfg.DATA_DIR, 'train',
                               base_size=cfg.TREE.BASE_SIZE,
@@ -662,14 +704,15 @@ if __name__ == "__main__":
         assert dataset
         dataloader = torch.utils.data.DataLoader(
             dataset, batch_size=batch_size, drop_last=True,
-            shuffle=True, num_workers=int(cfg.WORKERS))
+            shuffle=True, num_workers=int(cfg.WORKERS),
+            collate_fn=collate_data, pin_memory=cfg.CUDA)
 
     # # validation data #
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    netG = NetG(cfg.TRAIN.NF, 100).to(device)
-    netD = NetD(cfg.TRAIN.NF).to(device)
+    netG = NetG(cfg.TRAIN.NF, 100, checkpoint=cfg.TRAIN.CHECKPOINT_G).to(device)
+    netD = NetD(cfg.TRAIN.NF, checkpoint=cfg.TRAIN.CHECKPOINT_D).to(device)
     netG = DataParallelWithCallback(netG)
     netD = nn.DataParallel(netD)
 
@@ -696,11 +739,13 @@ if __name__ == "__main__":
 
 
     # Caption models - cnn_encoder and rnn_decoder
-    caption_cnn = CAPTION_CNN(cfg.CAP.embed_size)
-    caption_cnn.load_state_dict(torch.load(cfg.CAP.caption_cnn_path, map_location=lambda storage, loc: storage))
+    caption_cnn = caption_encoder(cfg.CAP.BACKBONE, cfg.CAP.embed_size)
+    caption_cnn_path = cfg.CAP.caption_cnn_path if cfg.CAP.BACKBONE == 'resnet152' \
+        else cfg.CAP.backbone_path
+    caption_cnn.load_state_dict(torch.load(caption_cnn_path, map_location=lambda storage, loc: storage))
     for p in caption_cnn.parameters():
         p.requires_grad = False
-    print('Load caption model from:', cfg.CAP.caption_cnn_path)
+    print('Load caption model from:', caption_cnn_path)
     caption_cnn.cuda()
     caption_cnn.eval()
 
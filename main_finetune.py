@@ -37,8 +37,9 @@ import matplotlib.pyplot as plt
 
 from miscc.utils import mkdir_p
 from miscc.utils import imagenet_deprocess_batch
+from miscc.utils import autocast, grad_scaler, scaled_step
 from miscc.config import cfg, cfg_from_file
-from miscc.losses import DAMSM_loss
+from miscc.losses import DAMSM_loss, magp_loss
 from sync_batchnorm import DataParallelWithCallback
 #from datasets_everycap import TextDataset
 from datasets import TextDataset
@@ -132,7 +133,7 @@ def sampling(text_encoder, netG, dataloader, ixtoword, device):
                 with torch.no_grad():
                     noise = torch.randn(batch_size, 100)
                     noise = noise.to(device)
-                    fake_imgs, _ = netG(noise, sent_emb)
+                    fake_imgs = netG(noise, sent_emb, return_masks=False)
                 for j in range(batch_size):
                     #s_tmp = '%s/single/%s' % (save_dir, keys[j])
                     s_tmp = '%s/single' % (img_save_dir)
@@ -259,6 +260,11 @@ def train(dataloader, ixtoword, netG, netD, text_encoder, image_encoder,
         iend = cfg.TRAIN.NET_G.rfind('.')
         state_epoch = int(cfg.TRAIN.NET_G[istart:iend])
 
+    # loss scaling of the fp16 TRAIN.AMP mode, pass-through otherwise
+    scalerD = grad_scaler(device)
+    scalerG = grad_scaler(device)
+    scalerEncoder = grad_scaler(device)
+
     for epoch in tqdm(range(state_epoch + 1, cfg.TRAIN.MAX_EPOCH + 1)):
         data_iter = iter(dataloader)
         # for step, data in enumerate(dataloader, 0):
@@ -273,67 +279,48 @@ def train(dataloader, ixtoword, netG, netD, text_encoder, image_encoder,
             words_embs_de, sent_emb_de = words_embs.detach(), sent_emb.detach()
 
             imgs = imags[0].to(device)
-            real_features = netD(imgs)
-            output = netD.module.COND_DNET(real_features, sent_emb_de)
-            errD_real = torch.nn.ReLU()(1.0 - output).mean()
+            with autocast(device):
+                real_features = netD(imgs)
+                output = netD.module.COND_DNET(real_features, sent_emb_de)
+                errD_real = torch.nn.ReLU()(1.0 - output).mean()
 
-            output = netD.module.COND_DNET(real_features[:(batch_size - 1)], sent_emb_de[1:batch_size])
-            errD_mismatch = torch.nn.ReLU()(1.0 + output).mean()
+                output = netD.module.COND_DNET(real_features[:(batch_size - 1)], sent_emb_de[1:batch_size])
+                errD_mismatch = torch.nn.ReLU()(1.0 + output).mean()
 
-            # synthesize fake images
-            noise = torch.randn(batch_size, 100)
-            noise = noise.to(device)
-            fake, _ = netG(noise, sent_emb_de)
+                # synthesize fake images
+                noise = torch.randn(batch_size, 100)
+                noise = noise.to(device)
+                fake = netG(noise, sent_emb_de, return_masks=False)
 
-            # update encoder
-            DAMSM_D = DAMSM_loss(image_encoder, imgs, real_labels, words_embs,
-                                 sent_emb, match_labels, cap_lens, class_ids)
-            optimizerEncoder.zero_grad()
-            DAMSM_D.backward()
-            optimizerEncoder.step()
+                # update encoder
+                DAMSM_D = DAMSM_loss(image_encoder, imgs, real_labels, words_embs,
+                                     sent_emb, match_labels, cap_lens, class_ids)
+            scaled_step(scalerEncoder, optimizerEncoder, DAMSM_D)
 
-            # G does not need update with D
-            fake_features = netD(fake.detach())
+            with autocast(device):
+                # G does not need update with D
+                fake_features = netD(fake.detach())
 
-            errD_fake = netD.module.COND_DNET(fake_features, sent_emb_de)
-            errD_fake = torch.nn.ReLU()(1.0 + errD_fake).mean()
+                errD_fake = netD.module.COND_DNET(fake_features, sent_emb_de)
+                errD_fake = torch.nn.ReLU()(1.0 + errD_fake).mean()
 
-            errD = errD_real + (errD_fake + errD_mismatch) / 2.0
-            optimizerD.zero_grad()
-            errD.backward()
-            optimizerD.step()
+                errD = errD_real + (errD_fake + errD_mismatch) / 2.0
+            scaled_step(scalerD, optimizerD, errD)
 
             # MA-GP
-            interpolated = (imgs.data).requires_grad_()
-            sent_inter = (sent_emb_de.data).requires_grad_()
-            features = netD(interpolated)
-            out = netD.module.COND_DNET(features, sent_inter)
-            grads = torch.autograd.grad(outputs=out,
-                                        inputs=(interpolated, sent_inter),
-                                        grad_outputs=torch.ones(out.size()).cuda(),
-                                        retain_graph=True,
-                                        create_graph=True,
-                                        only_inputs=True)
-            grad0 = grads[0].view(grads[0].size(0), -1)
-            grad1 = grads[1].view(grads[1].size(0), -1)
-            grad = torch.cat((grad0, grad1), dim=1)
-            grad_l2norm = torch.sqrt(torch.sum(grad ** 2, dim=1))
-            d_loss_gp = torch.mean((grad_l2norm) ** 6)
-            d_loss = 2.0 * d_loss_gp
-            optimizerD.zero_grad()
-            d_loss.backward()
-            optimizerD.step()
+            with autocast(device):
+                d_loss = 2.0 * magp_loss(netD, imgs, sent_emb_de, scaler=scalerD)
+            scaled_step(scalerD, optimizerD, d_loss)
 
             # update G
-            features = netD(fake)
-            output = netD.module.COND_DNET(features, sent_emb_de)
-            errG = - output.mean()
-            DAMSM_G = 0.1 * DAMSM_loss(image_encoder, fake, real_labels, words_embs_de,
-                                       sent_emb_de, match_labels, cap_lens, class_ids)
-            errG_total = errG + DAMSM_G
-            optimizerG.zero_grad()
-            errG_total.backward()
-            optimizerG.step()
+            with autocast(device):
+                features = netD(fake)
+                output = netD.module.COND_DNET(features, sent_emb_de)
+                errG = - output.mean()
+                DAMSM_G = 0.1 * DAMSM_loss(image_encoder, fake, real_labels, words_embs_de,
+                                           sent_emb_de, match_labels, cap_lens, class_ids)
+                errG_total = errG + DAMSM_G
+            scaled_step(scalerG, optimizerG, errG_total)
 
         #cap_imgs = cap2img(ixtoword, captions, cap_lens)
         #write_images_losses(writer, cap_imgs, imgs, fake, errD, d_loss, DAMSM_D, errG, DAMSM_G, epoch)
@@ -394,6 +381,11 @@ if __name__ == "__main__":
         transforms.Resize(int(imsize * 76 / 64)),
         transforms.RandomCrop(imsize),
         transforms.RandomHorizontalFlip()])
+    if cfg.IMG_SHARDS:
+        # shard images are already cropped and resized offline
+        image_transform = transforms.Compose([
+            transforms.RandomCrop(imsize),
+            transforms.RandomHorizontalFlip()])
     if cfg.B_VALIDATION:
         dataset = TextDataset(cfg.DATA_DIR, 'test',
                               base_size=cfg.TREE.BASE_SIZE,
@@ -419,8 +411,8 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    netG = NetG(cfg.TRAIN.NF, 100).to(device)
-    netD = NetD(cfg.TRAIN.NF).to(device)
+    netG = NetG(cfg.TRAIN.NF, 100, checkpoint=cfg.TRAIN.CHECKPOINT_G).to(device)
+    netD = NetD(cfg.TRAIN.NF, checkpoint=cfg.TRAIN.CHECKPOINT_D).to(device)
     netG = DataParallelWithCallback(netG)
     netD = nn.DataParallel(netD)
 
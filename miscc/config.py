@@ -25,6 +25,7 @@ __C.DATA_DIR = ''
 __C.GPU_ID = 0
 __C.CUDA = True
 __C.WORKERS = 6
+__C.IMG_SHARDS = False  # read pre-resized images written by preprocess.py
 
 __C.RNN_TYPE = 'LSTM'   # 'GRU'
 __C.B_VALIDATION = False
@@ -55,6 +56,16 @@ __C.TRAIN.SMOOTH.GAMMA1 = 5.0
 __C.TRAIN.SMOOTH.GAMMA3 = 10.0
 __C.TRAIN.SMOOTH.GAMMA2 = 5.0
 __C.TRAIN.SMOOTH.LAMBDA = 1.0
+__C.TRAIN.WORDS_LOSS_CHUNK = 0  # captions per words_loss pass, 0 for all
+__C.TRAIN.SHARE_REAL_D = True  # run netD once on the real images of both caption orders
+__C.TRAIN.MAGP_MODE = 'separate'  # 'separate': own D update, 'joint': one backward with the hinge loss
+__C.TRAIN.MAGP_INTERVAL = 1  # lazy regularization, apply MA-GP every k steps with k times the weight
+__C.TRAIN.AMP = False  # mixed precision with torch.autocast
+__C.TRAIN.AMP_DTYPE = 'float16'  # 'float16' (with GradScaler on CUDA) or 'bfloat16'
+__C.TRAIN.CHECKPOINT_G = []  # NetG blocks to recompute in backward, e.g. ['block5', 'block6']
+__C.TRAIN.CHECKPOINT_D = []  # NetD layers to recompute in backward, e.g. ['conv_img', 'block0']
+__C.TRAIN.QUEUE_SIZE = 0  # past cnn_code embeddings kept as extra contrastive negatives, 0 to disable
+__C.TRAIN.QUEUE_MAX_AGE = 0  # drop queued negatives older than this many steps, 0 to keep all
 __C.TRAIN.WARMUP_EPOCHS = 200
 __C.TRAIN.GSAVE_INTERVAL = 10
 __C.TRAIN.DSAVE_INTERVAL = 10
@@ -76,6 +87,7 @@ __C.TEXT.CAPTIONS_PER_IMAGE = 10
 __C.TEXT.EMBEDDING_DIM = 256
 __C.TEXT.WORDS_NUM = 18
 __C.TEXT.DAMSM_NAME = '../DAMSMencoders/coco/text_encoder200.pth'
+__C.TEXT.EMB_CACHE = False  # read RNN_ENCODER outputs written by preprocess.py
 
 
 
@@ -86,6 +98,8 @@ __C.CAP.num_layers = 1
 __C.CAP.learning_rate = 0.001
 __C.CAP.caption_cnn_path = ''
 __C.CAP.caption_rnn_path = ''
+__C.CAP.BACKBONE = 'resnet152'  # image side of the recaption loss: 'resnet152', 'inception' or 'distilled'
+__C.CAP.backbone_path = ''  # weights of the 'inception' head or the 'distilled' encoder (distill.py)
 
 
 def _merge_a_into_b(a, b):
@@ -9,13 +9,13 @@
 '''
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 import numpy as np
 from miscc.config import cfg
 
 from GlobalAttention import func_attention
 
-from torch.nn.utils.rnn import pack_padded_sequence
 
 # ##################Loss for matching text-image###################
 def cosine_similarity(x1, x2, dim=1, eps=1e-8):
@@ -27,20 +27,26 @@ def cosine_similarity(x1, x2, dim=1, eps=1e-8):
     return (w12 / (w1 * w2).clamp(min=eps)).squeeze()
 
 
+def class_masks(class_ids, device):
+    """Mask of mis-match pairs that come from the same class.
+
+    masks(i, j) is True when the j-th sample has the class of the i-th one
+    (i != j). Built once per batch on the device and shared by sent_loss
+    and words_loss.
+    """
+    class_ids = torch.as_tensor(class_ids, device=device)
+    # masks: batch_size x batch_size
+    masks = class_ids.unsqueeze(0) == class_ids.unsqueeze(1)
+    masks.fill_diagonal_(False)
+    return masks
+
+
 def sent_loss(cnn_code, rnn_code, labels, class_ids,
-              batch_size, eps=1e-8):
+              batch_size, eps=1e-8, masks=None):
     # ### Mask mis-match samples  ###
     # that come from the same class as the real sample ###
-    masks = []
-    if class_ids is not None:
-        for i in range(batch_size):
-            mask = class_ids == class_ids[i]
-            mask[i] = 0
-            masks.append(mask.view(1, -1))
-        # masks: batch_size x batch_size
-        masks = torch.cat(masks, dim=0)
-        if cfg.CUDA:
-            masks = masks.cuda()
+    if masks is None and class_ids is not None:
+        masks = class_masks(class_ids, cnn_code.device)
 
     # --> seq_len x batch_size x nef
     if cnn_code.dim() == 2:
@@ -57,7 +63,7 @@ def sent_loss(cnn_code, rnn_code, labels, class_ids,
 
     # --> batch_size x batch_size
     scores0 = scores0.squeeze()
-    if class_ids is not None:
+    if masks is not None:
         scores0.data.masked_fill_(masks, -float('inf'))
     scores1 = scores0.transpose(0, 1)
     if labels is not None:
@@ -69,67 +75,73 @@ def sent_loss(cnn_code, rnn_code, labels, class_ids,
 
 
 def words_loss(img_features, words_emb, labels,
-               cap_lens, class_ids, batch_size):
+               cap_lens, class_ids, batch_size, chunk_size=0, masks=None,
+               return_att_maps=False):
     """
         words_emb(query): batch x nef x seq_len
         img_features(context): batch x nef x 17 x 17
+
+        Every caption is attended against every image in one batched pass,
+        with the words past cap_lens masked out. chunk_size > 0 processes
+        that many captions at a time to bound memory.
+        The per-caption attention maps need the lengths on the host, so
+        they are only built with return_att_maps (None otherwise).
     """
-    masks = []
-    att_maps = []
+    if masks is None and class_ids is not None:
+        masks = class_masks(class_ids, words_emb.device)
+
+    seq_len = words_emb.size(2)
+    # batch x seq_len, True for padding
+    cap_lens = cap_lens.to(words_emb.device)
+    pad = torch.arange(seq_len, device=words_emb.device).unsqueeze(0) >= \
+        cap_lens.unsqueeze(1)
+
+    if chunk_size <= 0:
+        chunk_size = batch_size
+    att_maps = [] if return_att_maps else None
     similarities = []
-    cap_lens = cap_lens.data.tolist()
-    for i in range(batch_size):
-        if class_ids is not None:
-            mask = (class_ids == class_ids[i])
-            mask[i] = 0
-            masks.append(mask.view(1, -1))
-        # Get the i-th text description
-        words_num = cap_lens[i]
-        # -> 1 x nef x words_num
-        word = words_emb[i, :, :words_num].unsqueeze(0).contiguous()
-        # -> batch_size x nef x words_num
-        word = word.repeat(batch_size, 1, 1)
-        # batch x nef x 17*17
-        context = img_features
+    for start in range(0, batch_size, chunk_size):
+        # n captions x nef x seq_len
+        word = words_emb[start:start + chunk_size]
+        word_pad = pad[start:start + chunk_size]
+        n = word.size(0)
         """
-            word(query): batch x nef x words_num
-            context: batch x nef x 17 x 17
-            weiContext: batch x nef x words_num
-            attn: batch x words_num x 17 x 17
+            word(query): n x 1 x nef x seq_len
+            context: 1 x batch x nef x 17 x 17
+            weiContext: n x batch x nef x seq_len
+            attn: n x batch x seq_len x 17 x 17
         """
-        weiContext, attn = func_attention(word, context, cfg.TRAIN.SMOOTH.GAMMA1)
-        att_maps.append(attn[i].unsqueeze(0).contiguous())
-        # --> batch_size x words_num x nef
-        word = word.transpose(1, 2).contiguous()
-        weiContext = weiContext.transpose(1, 2).contiguous()
-        # --> batch_size*words_num x nef
-        word = word.view(batch_size * words_num, -1)
-        weiContext = weiContext.view(batch_size * words_num, -1)
-        #
-        # -->batch_size*words_num
-        row_sim = cosine_similarity(word, weiContext)
-        # --> batch_size x words_num
-        row_sim = row_sim.view(batch_size, words_num)
+        weiContext, attn = func_attention(word.unsqueeze(1), img_features.unsqueeze(0),
+                                          cfg.TRAIN.SMOOTH.GAMMA1, word_pad.unsqueeze(1))
+        if return_att_maps:
+            for k in range(n):
+                att_maps.append(attn[k, start + k].unsqueeze(0))
+
+        # --> n x batch x seq_len
+        w12 = torch.sum(word.unsqueeze(1) * weiContext, 2)
+        w1 = torch.norm(word, 2, 1).unsqueeze(1)
+        w2 = torch.norm(weiContext, 2, 2)
+        row_sim = w12 / (w1 * w2).clamp(min=1e-8)
 
         # Eq. (10)
-        row_sim.mul_(cfg.TRAIN.SMOOTH.GAMMA2).exp_()
-        row_sim = row_sim.sum(dim=1, keepdim=True)
-        row_sim = torch.log(row_sim)
+        row_sim = torch.exp(row_sim * cfg.TRAIN.SMOOTH.GAMMA2)
+        row_sim = row_sim.masked_fill(word_pad.unsqueeze(1), 0)
+        row_sim = torch.log(row_sim.sum(dim=2))
 
-        # --> 1 x batch_size
-        # similarities(i, j): the similarity between the i-th image and the j-th text description
+        # --> n x batch
         similarities.append(row_sim)
 
     # batch_size x batch_size
-    similarities = torch.cat(similarities, 1)
-    if class_ids is not None:
-        # masks: batch_size x batch_size
-        masks = torch.cat(masks, dim=0)
-        if cfg.CUDA:
-            masks = masks.cuda()
+    # similarities(i, j): the similarity between the i-th image and the j-th text description
+    similarities = torch.cat(similarities, 0).transpose(0, 1)
+
+    if return_att_maps:
+        # trim the attention maps to each caption's own length
+        words_nums = cap_lens.data.tolist()
+        att_maps = [attn[:, :words_num] for attn, words_num in zip(att_maps, words_nums)]
 
     similarities = similarities * cfg.TRAIN.SMOOTH.GAMMA3
-    if class_ids is not None:
+    if masks is not None:
         similarities.data.masked_fill_(masks, -float('inf'))
     similarities1 = similarities.transpose(0, 1)
     if labels is not None:
@@ -169,25 +181,64 @@ def discriminator_loss(netD, real_imgs, fake_imgs, conditions,
     return errD
 
 
+def magp_loss(netD, imgs, sent_emb, out=None, scaler=None):
+    """Matching-aware gradient penalty at the real image-text pairs.
+
+    out: COND_DNET logits of a forward that already tracks gradients of
+    imgs and sent_emb, whose graph is then reused. Without it, netD is run
+    again on detached copies of the inputs.
+    scaler: GradScaler of the D update; the input gradients are taken on
+    the scaled logits and unscaled, so fp16 gradients do not underflow.
+    """
+    if out is None:
+        imgs = imgs.data.requires_grad_()
+        sent_emb = sent_emb.data.requires_grad_()
+        features = netD(imgs)
+        out = netD.module.COND_DNET(features, sent_emb)
+    inv_scale = None
+    if scaler is not None and scaler.is_enabled():
+        # the current scale as a device tensor; get_scale() would sync
+        inv_scale = scaler.scale(torch.ones((), device=out.device)).reciprocal()
+        out = scaler.scale(out)
+    grads = torch.autograd.grad(outputs=out,
+                                inputs=(imgs, sent_emb),
+                                grad_outputs=torch.ones_like(out),
+                                retain_graph=True,
+                                create_graph=True,
+                                only_inputs=True)
+    if inv_scale is not None:
+        grads = [grad * inv_scale.to(grad.dtype) for grad in grads]
+    grad0 = grads[0].view(grads[0].size(0), -1)
+    grad1 = grads[1].view(grads[1].size(0), -1)
+    grad = torch.cat((grad0, grad1), dim=1)
+    grad_l2norm = torch.sqrt(torch.sum(grad ** 2, dim=1))
+    return torch.mean((grad_l2norm) ** 6)
+
+
 def DAMSM_loss(image_encoder, fake_imgs, real_labels,
                words_embs, sent_emb, match_labels,
-               cap_lens, class_ids):
-    class_ids = torch.LongTensor(class_ids)
+               cap_lens, class_ids, masks=None,
+               region_features=None, cnn_code=None):
     batch_size = real_labels.size(0)
-    # Forward
+    if masks is None and class_ids is not None:
+        masks = class_masks(class_ids, sent_emb.device)
+    # Forward, unless the image_encoder features are passed in
 
     # words_features: batch_size x nef x 17 x 17
     # sent_code: batch_size x nef
-    region_features, cnn_code = image_encoder(fake_imgs)
+    if region_features is None:
+        region_features, cnn_code = image_encoder(fake_imgs)
     w_loss0, w_loss1, _ = words_loss(region_features, words_embs,
                                      match_labels, cap_lens,
-                                     class_ids, batch_size)
+                                     class_ids, batch_size,
+                                     cfg.TRAIN.WORDS_LOSS_CHUNK, masks)
     w_loss = (w_loss0 + w_loss1) * \
         cfg.TRAIN.SMOOTH.LAMBDA
     # err_words = err_words + w_loss.data[0]
 
     s_loss0, s_loss1 = sent_loss(cnn_code, sent_emb,
-                                 match_labels, class_ids, batch_size)
+                                 match_labels, class_ids, batch_size,
+                                 masks=masks)
     s_loss = (s_loss0 + s_loss1) * \
         cfg.TRAIN.SMOOTH.LAMBDA
     # err_sent = err_sent + s_loss.data[0]
@@ -201,15 +252,17 @@ def caption_loss(cap_output, captions):
     caption_loss = criterion(cap_output, captions)
     return caption_loss
 
-def recaption_loss(caption_cnn,caption_rnn,fake_imgs,captions,cap_lens,device):
-    fakeimg_feature = caption_cnn(fake_imgs)
-    captions.to(device)
-    lengths = [int(a) for a in cap_lens.data.tolist()]
-    # print(captions)
-    target_cap = pack_padded_sequence(captions,cap_lens.cpu(), batch_first=True)
-    target_cap=target_cap[0].to(device)
-    cap_output = caption_rnn(fakeimg_feature, captions, cap_lens)
-    cap_loss = caption_loss(cap_output, target_cap) * 0.5 # lambda =10
+def recaption_loss(caption_cnn,caption_rnn,fake_imgs,captions,cap_lens,device,fakeimg_feature=None):
+    if fakeimg_feature is None:
+        fakeimg_feature = caption_cnn(fake_imgs)
+    # logits and targets stay padded and the padding is masked out of the
+    # cross-entropy, so the lengths never go to the host
+    cap_output = caption_rnn.forward_padded(fakeimg_feature, captions)
+    mask = torch.arange(captions.size(1), device=captions.device).unsqueeze(0) < \
+        cap_lens.unsqueeze(1)
+    token_loss = F.cross_entropy(cap_output.transpose(1, 2), captions, reduction='none')
+    # mean over the caption tokens, as the packed cross-entropy
+    cap_loss = (token_loss * mask).sum() / mask.sum() * 0.5 # lambda =10
     return cap_loss
 
 
@@ -321,6 +321,27 @@ def copy_G_params(model):
     return flatten
 
 
+def autocast(device):
+    """Autocast context of the TRAIN.AMP mode, a no-op when AMP is off."""
+    return torch.autocast(torch.device(device).type,
+                          dtype=getattr(torch, cfg.TRAIN.AMP_DTYPE),
+                          enabled=cfg.TRAIN.AMP)
+
+
+def grad_scaler(device):
+    """GradScaler for fp16 on CUDA, pass-through for bf16, CPU or no AMP."""
+    enabled = cfg.TRAIN.AMP and cfg.TRAIN.AMP_DTYPE == 'float16' and \
+        torch.device(device).type == 'cuda'
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def scaled_step(scaler, optimizer, loss):
+    optimizer.zero_grad()
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -7,10 +7,14 @@
 @Version     :0.1
 @Description : Implementation of SSA-GAN
 '''
+import copy
+
 import torch
 import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from torch.nn.modules.batchnorm import _BatchNorm
 from collections import OrderedDict
 from sync_batchnorm import SynchronizedBatchNorm2d
 
@@ -20,8 +24,42 @@ from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 BatchNorm = SynchronizedBatchNorm2d
 
+
+def _run(module, use_checkpoint, *args, **kwargs):
+    """module(*args, **kwargs), recomputed in the backward pass when
+    use_checkpoint is set. The non-reentrant checkpoint also supports the
+    double backward of the MA-GP penalty."""
+    if use_checkpoint and torch.is_grad_enabled():
+        calls = []
+
+        def run(*inputs):
+            if not calls:
+                calls.append(True)
+                return module(*inputs, **kwargs)
+            # recomputation: the BatchNorm running statistics were already
+            # updated by the forward pass and must not see the batch again
+            stats = [(bn, name, getattr(bn, name).clone()) for bn in module.modules()
+                     if isinstance(bn, _BatchNorm)
+                     for name in ('running_mean', 'running_var', 'num_batches_tracked')
+                     if getattr(bn, name, None) is not None]
+            out = module(*inputs, **kwargs)
+            with torch.no_grad():
+                for bn, name, saved in stats:
+                    getattr(bn, name).copy_(saved)
+            return out
+        return checkpoint(run, *args, use_reentrant=False)
+    return module(*args, **kwargs)
+
+
+def _checkpoint_names(module, names):
+    names = set(names)
+    unknown = [name for name in names if not isinstance(getattr(module, name, None), nn.Module)]
+    if unknown:
+        raise ValueError('no such block to checkpoint: %s' % ', '.join(sorted(unknown)))
+    return names
+
 class NetG(nn.Module):
-    def __init__(self, ngf=64, nz=100):
+    def __init__(self, ngf=64, nz=100, checkpoint=()):
         super(NetG, self).__init__()
         self.ngf = ngf
 
@@ -46,64 +84,302 @@ class NetG(nn.Module):
             nn.Conv2d(ngf, 3, 3, 1, 1),
             nn.Tanh(),
         )
+        # names of the blocks whose activations are recomputed in backward
+        self.checkpoint = _checkpoint_names(self, checkpoint)
+        # eval-mode packed affine weights of modulation, per (device, dtype)
+        self._packed = {}
+
+    def blocks(self):
+        return [self.block0, self.block1, self.block2, self.block3,
+                self.block4, self.block5, self.block6]
+
+    def train(self, mode=True):
+        self._packed.clear()
+        return super(NetG, self).train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # also reached through DataParallel wrappers, unlike load_state_dict
+        self._packed.clear()
+        super(NetG, self)._load_from_state_dict(*args, **kwargs)
+
+    def _pack(self):
+        """linear1 weights of all affine MLPs as one matrix and their
+        linear2 weights stacked per run of equal width:
+        (w1, b1, [(start, end, w2, b2), ...])."""
+        mlps = [mlp for block in self.blocks()
+                for layer in (block.affine0, block.affine2)
+                for mlp in (layer.fc_gamma, layer.fc_beta)]
+        # 28*256 x 256
+        w1 = torch.cat([mlp.linear1.weight for mlp in mlps], 0)
+        b1 = torch.cat([mlp.linear1.bias for mlp in mlps], 0)
+
+        groups = []
+        start = 0
+        while start < len(mlps):
+            num_features = mlps[start].linear2.out_features
+            end = start
+            while end < len(mlps) and mlps[end].linear2.out_features == num_features:
+                end += 1
+            # n x 256 x num_features, n x 1 x num_features
+            w2 = torch.stack([mlp.linear2.weight.t() for mlp in mlps[start:end]])
+            b2 = torch.stack([mlp.linear2.bias for mlp in mlps[start:end]]).unsqueeze(1)
+            groups.append((start, end, w2, b2))
+            start = end
+        return w1, b1, groups
+
+    def _packed_weights(self):
+        # the weights only change in training, so eval mode packs them once;
+        # the cache is detached and cleared by train() and by loading a
+        # state dict, directly or through a wrapper
+        if self.training:
+            return self._pack()
+        weight = self.block0.affine0.fc_gamma.linear1.weight
+        key = (weight.device, weight.dtype)
+        if key not in self._packed:
+            with torch.no_grad():
+                self._packed[key] = self._pack()
+        return self._packed[key]
+
+    def modulation(self, c):
+        """Gamma and beta of every affine layer in one batched projection.
+
+        The linear1 layers of all 28 fc_gamma / fc_beta MLPs run as a single
+        linear, their linear2 layers as one baddbmm per run of equal width.
+        The parameters stay in the affine modules, so state dicts are
+        unchanged; in eval mode their packed copies are reused across calls.
+        Returns one (weight, bias) pair per affine, in the order
+        block0.affine0, block0.affine2, block1.affine0, ...
+        """
+        if c.dim() == 1:
+            c = c.unsqueeze(0)
+        w1, b1, groups = self._packed_weights()
+
+        # --> 28 x batch x 256
+        h = F.relu(F.linear(c, w1, b1))
+        h = h.view(c.size(0), groups[-1][1], -1).transpose(0, 1)
+
+        outs = []
+        for start, end, w2, b2 in groups:
+            # --> n x batch x num_features
+            outs.extend(torch.baddbmm(b2, h[start:end], w2).unbind(0))
+        return [(outs[k], outs[k + 1]) for k in range(0, len(outs), 2)]
+
+    def condition(self, c):
+        """Caption stage of the generator: all block modulation tensors.
+
+        Rows of a 1 x 256 sentence embedding broadcast over any noise batch
+        in synthesize.
+        """
+        return self.modulation(c)
+
+    def forward(self, x, c, return_masks=True):
+        return self.synthesize(x, self.condition(c), return_masks)
+
+    def synthesize(self, x, modulation, return_masks=True):
+        """Noise stage of the generator, given the output of condition.
+
+        return_masks: True for the image and all seven fusion masks (at 4,
+        8, ..., 256), False for the image alone, or an iterable of stage
+        indices (0 for 4x4 ... 6 for 256x256) for the image and those masks.
+        """
+        if return_masks is True:
+            keep = set(range(7))
+        elif return_masks is False:
+            keep = set()
+        else:
+            keep = set(return_masks)
 
-    def forward(self, x, c):
+        out, stage_mask = self._stem(x)
+        stage_masks = []
+        out, _ = self._run_blocks(out, stage_mask, modulation, 0, 7, keep, stage_masks)
+        out = self.conv_img(out)
 
+        if return_masks is False:
+            return out
+        return out, stage_masks
+
+    def preview(self, x, modulation, heads, size=64):
+        """Coarse image of the 64 (after block4) or 128 (after block5) stage.
+
+        Returns the image of the PreviewHeads and a state that refine
+        continues from, so the full image only costs the remaining blocks.
+        """
+        out, stage_mask = self._stem(x)
+        return self.refine((0, out, stage_mask), modulation, heads, size)
+
+    def refine(self, state, modulation, heads=None, size=256):
+        """Continues a preview state to the 128 preview or the full image.
+
+        Without heads the 64 / 128 stage features are returned in place of
+        the preview image, as used to distill the heads.
+        """
+        stop = {64: 5, 128: 6, 256: 7}[size]
+        start, out, stage_mask = state
+        # the mask head of the last block only feeds the next block, which a
+        # preview does not run; refine computes it when needed
+        out, stage_mask = self._run_blocks(out, stage_mask, modulation, start, stop,
+                                           last_mask=False)
+        state = (stop, out, stage_mask)
+        if size == 256:
+            return self.conv_img(out), state
+        if heads is None:
+            return out, state
+        return heads(out, size), state
+
+    def _stem(self, x):
         out = self.fc(x)
         out = out.view(x.size(0), 8 * self.ngf, 4, 4)
-        hh, ww = out.size(2), out.size(3)
-        stage_mask = self.conv_mask(out)
-        fusion_mask = torch.sigmoid(stage_mask)
-        stage_mask_4 = fusion_mask
-        out, stage_mask = self.block0(out, c, fusion_mask)
-
-        out = F.interpolate(out, scale_factor=2)
-        hh, ww = out.size(2), out.size(3)
-        stage_mask = F.interpolate(stage_mask, size=(hh, ww), mode='bilinear', align_corners=True)
-        fusion_mask = torch.sigmoid(stage_mask)
-        stage_mask_8 = fusion_mask
-        out, stage_mask = self.block1(out, c, fusion_mask)
-
-        out = F.interpolate(out, scale_factor=2)
-        hh, ww = out.size(2), out.size(3)
-        stage_mask = F.interpolate(stage_mask, size=(hh, ww), mode='bilinear', align_corners=True)
-        fusion_mask = torch.sigmoid(stage_mask)
-        stage_mask_16 = fusion_mask
-        out, stage_mask = self.block2(out, c, fusion_mask)
-
-        out = F.interpolate(out, scale_factor=2)
-        hh, ww = out.size(2), out.size(3)
-        stage_mask = F.interpolate(stage_mask, size=(hh, ww), mode='bilinear', align_corners=True)
-        fusion_mask = torch.sigmoid(stage_mask)
-        stage_mask_32 = fusion_mask
-        out, stage_mask = self.block3(out, c, fusion_mask)
-
-        out = F.interpolate(out, scale_factor=2)
-        hh, ww = out.size(2), out.size(3)
-        stage_mask = F.interpolate(stage_mask, size=(hh, ww), mode='bilinear', align_corners=True)
-        fusion_mask = torch.sigmoid(stage_mask)
-        stage_mask_64 = fusion_mask
-        out, stage_mask = self.block4(out, c, fusion_mask)
-
-        out = F.interpolate(out, scale_factor=2)
-        hh, ww = out.size(2), out.size(3)
-        stage_mask = F.interpolate(stage_mask, size=(hh, ww), mode='bilinear', align_corners=True)
-        fusion_mask = torch.sigmoid(stage_mask)
-        stage_mask_128 = fusion_mask
-        out, stage_mask = self.block5(out, c, fusion_mask)
-
-        out = F.interpolate(out, scale_factor=2)
-        hh, ww = out.size(2), out.size(3)
-        stage_mask = F.interpolate(stage_mask, size=(hh, ww), mode='bilinear', align_corners=True)
-        fusion_mask = torch.sigmoid(stage_mask)
-        stage_mask_256 = fusion_mask
-        out, _ = self.block6(out, c, fusion_mask)
+        return out, self.conv_mask(out)
+
+    def _run_blocks(self, out, stage_mask, modulation, start, stop,
+                    keep=(), stage_masks=None, last_mask=True):
+        blocks = self.blocks()
+        for i in range(start, stop):
+            if stage_mask is None:
+                # skipped at the end of a preview
+                stage_mask = blocks[i - 1].conv_mask(out)
+            if i > 0:
+                out = F.interpolate(out, scale_factor=2)
+                hh, ww = out.size(2), out.size(3)
+                stage_mask = F.interpolate(stage_mask, size=(hh, ww), mode='bilinear', align_corners=True)
+            fusion_mask = torch.sigmoid(stage_mask)
+            if i in keep:
+                stage_masks.append(fusion_mask)
+            out, stage_mask = _run(blocks[i], 'block%d' % i in self.checkpoint,
+                                   out, None, fusion_mask, modulation[2 * i:2 * i + 2],
+                                   predict_mask=last_mask or i < stop - 1)
+        return out, stage_mask
+
+
+class PreviewHeads(nn.Module):
+    """Light to-RGB heads on the 64 and 128 stages of NetG.
+
+    Kept out of NetG so that its checkpoints are unchanged; distill.py
+    trains them against the downsampled full output.
+    """
+
+    def __init__(self, ngf=64):
+        super(PreviewHeads, self).__init__()
+        self.rgb64 = self._head(ngf * 4)
+        self.rgb128 = self._head(ngf * 2)
+
+    @staticmethod
+    def _head(ch):
+        return nn.Sequential(
+            nn.BatchNorm2d(ch),
+            nn.LeakyReLU(0.2, inplace=True),
+            nn.Conv2d(ch, 3, 3, 1, 1),
+            nn.Tanh(),
+        )
+
+    def forward(self, x, size=64):
+        return getattr(self, 'rgb%d' % size)(x)
 
-        out = self.conv_img(out)
 
-        # return out, fusion_mask
-        return out, [stage_mask_4, stage_mask_8, stage_mask_16, stage_mask_32,
-                     stage_mask_64, stage_mask_128, stage_mask_256]
+class ConditionCache(object):
+    """LRU cache of NetG conditions keyed by caption token ids.
+
+    Sweeping the noise for a fixed caption then only runs the convolutions
+    of NetG.synthesize; the text encoder and the modulation MLPs run once
+    per caption.
+    """
+
+    def __init__(self, text_encoder, netG, capacity=128):
+        self.text_encoder = text_encoder
+        self.netG = getattr(netG, 'module', netG)
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __call__(self, caption, cap_len):
+        """Condition of one caption (1-D token ids), with a batch size of 1."""
+        cap_len = int(cap_len)
+        key = tuple(int(w) for w in caption[:cap_len])
+        if key in self.entries:
+            cond = self.entries.pop(key)
+        else:
+            with torch.no_grad():
+                caption = caption[:cap_len].view(1, -1)
+                hidden = self.text_encoder.init_hidden(1)
+                _, sent_emb = self.text_encoder(caption, torch.LongTensor([cap_len]), hidden)
+                cond = self.netG.condition(sent_emb)
+            if len(self.entries) >= self.capacity:
+                self.entries.popitem(last=False)
+        self.entries[key] = cond
+        return cond
+
+    def batch(self, captions, cap_lens):
+        """Conditions of several captions stacked along the batch."""
+        conds = [self(caption, cap_len) for caption, cap_len in zip(captions, cap_lens)]
+        return [tuple(torch.cat(t, 0) for t in zip(*layers)) for layers in zip(*conds)]
+
+
+def _bn_scale_shift(bn):
+    """Per-channel y = scale * x + shift of an eval-mode BatchNorm."""
+    scale = (bn.running_var + bn.eps).rsqrt()
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift * bn.weight + bn.bias
+        scale = scale * bn.weight
+    return scale, shift
+
+
+def _scale_conv(conv, scale, shift):
+    """Fold y = scale * conv(x) + shift into the weight and bias of conv."""
+    conv.weight.mul_(scale.view(-1, 1, 1, 1))
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(scale)
+    conv.bias = nn.Parameter(bias * scale + shift)
+
+
+def _to_batchnorm(module):
+    """Swap SynchronizedBatchNorm2d for plain nn.BatchNorm2d in eval mode."""
+    for name, child in module.named_children():
+        if isinstance(child, SynchronizedBatchNorm2d):
+            bn = nn.BatchNorm2d(child.num_features, child.eps, child.momentum, child.affine)
+            bn.load_state_dict(child.state_dict())
+            setattr(module, name, bn.eval())
+        else:
+            _to_batchnorm(child)
+
+
+def export_netG(netG, channels_last=True, example_inputs=None):
+    """Frozen copy of NetG for inference.
+
+    The BatchNorm of every conv_mask is folded into the conv before it, and
+    the BatchNorm of conv_img into c2 and c_sc of block6, whose sum it
+    normalizes. The remaining BatchNorms, which normalize the inputs of the
+    affine layers, become plain nn.BatchNorm2d. With example_inputs
+    (noise, sent_emb) the module is traced with torch.jit.
+    """
+    netG = copy.deepcopy(getattr(netG, 'module', netG)).eval()
+    with torch.no_grad():
+        conv_masks = [netG.conv_mask] + [block.conv_mask for block in netG.blocks()
+                                         if block.predict_mask]
+        for conv_mask in conv_masks:
+            scale, shift = _bn_scale_shift(conv_mask[1])
+            _scale_conv(conv_mask[0], scale, shift)
+            conv_mask[1] = nn.Identity()
+
+        # conv_img[0] normalizes c_sc(x) + gamma * c2(h) of block6
+        if netG.block6.learnable_sc:
+            scale, shift = _bn_scale_shift(netG.conv_img[0])
+            _scale_conv(netG.block6.c_sc, scale, shift)
+            _scale_conv(netG.block6.c2, scale, torch.zeros_like(shift))
+            netG.conv_img[0] = nn.Identity()
+
+        _to_batchnorm(netG)
+    for p in netG.parameters():
+        p.requires_grad_(False)
+    if channels_last:
+        netG = netG.to(memory_format=torch.channels_last)
+    if example_inputs is not None:
+        netG = torch.jit.trace(netG, example_inputs, strict=False)
+    return netG
 
 
 class G_Block(nn.Module):
@@ -129,10 +405,10 @@ class G_Block(nn.Module):
                                            nn.ReLU(),
                                            nn.Conv2d(100, 1, 1, 1, 0))
 
-    def forward(self, x, y=None, fusion_mask=None):
-        out = self.shortcut(x) + self.gamma * self.residual(x, y, fusion_mask)
+    def forward(self, x, y=None, fusion_mask=None, modulation=None, predict_mask=True):
+        out = self.shortcut(x) + self.gamma * self.residual(x, y, fusion_mask, modulation)
 
-        if self.predict_mask:
+        if self.predict_mask and predict_mask:
             mask = self.conv_mask(out)
         else:
             mask = None
@@ -144,12 +420,14 @@ class G_Block(nn.Module):
             x = self.c_sc(x)
         return x
 
-    def residual(self, x, y=None, fusion_mask=None):
-        h = self.affine0(x, y, fusion_mask)
+    def residual(self, x, y=None, fusion_mask=None, modulation=None):
+        # modulation: precomputed (weight, bias) of affine0 and affine2
+        mod0, mod2 = modulation if modulation is not None else (None, None)
+        h = self.affine0(x, y, fusion_mask, mod0)
         h = nn.ReLU(inplace=True)(h)
         h = self.c1(h)
 
-        h = self.affine2(h, y, fusion_mask)
+        h = self.affine2(h, y, fusion_mask, mod2)
         h = nn.ReLU(inplace=True)(h)
         return self.c2(h)
 
@@ -179,10 +457,13 @@ class affine(nn.Module):
         nn.init.zeros_(self.fc_beta.linear2.weight.data)
         nn.init.zeros_(self.fc_beta.linear2.bias.data)
 
-    def forward(self, x, y=None, fusion_mask=None):
+    def forward(self, x, y=None, fusion_mask=None, modulation=None):
         x = self.batch_norm2d(x)
-        weight = self.fc_gamma(y)
-        bias = self.fc_beta(y)
+        if modulation is None:
+            weight = self.fc_gamma(y)
+            bias = self.fc_beta(y)
+        else:
+            weight, bias = modulation
 
         if weight.dim() == 1:
             weight = weight.unsqueeze(0)
@@ -219,7 +500,7 @@ class D_GET_LOGITS(nn.Module):
 
 # 定义鉴别器网络D
 class NetD(nn.Module):
-    def __init__(self, ndf):
+    def __init__(self, ndf, checkpoint=()):
         super(NetD, self).__init__()
 
         self.conv_img = nn.Conv2d(3, ndf, 3, 1, 1)  # 128
@@ -231,16 +512,15 @@ class NetD(nn.Module):
         self.block5 = resD(ndf * 16, ndf * 16)  # 4
 
         self.COND_DNET = D_GET_LOGITS(ndf)
+        # names of the layers whose activations are recomputed in backward
+        self.checkpoint = _checkpoint_names(self, checkpoint)
 
     def forward(self, x):
 
-        out = self.conv_img(x)
-        out = self.block0(out)
-        out = self.block1(out)
-        out = self.block2(out)
-        out = self.block3(out)
-        out = self.block4(out)
-        out = self.block5(out)
+        out = x
+        for name in ('conv_img', 'block0', 'block1', 'block2',
+                     'block3', 'block4', 'block5'):
+            out = _run(getattr(self, name), name in self.checkpoint, out)
 
         return out
 
@@ -308,14 +588,58 @@ class CAPTION_CNN(nn.Module):
     def forward(self, images):
         """Extract feature vectors from input images."""
         #print ('image feature size before unsample:', images.size())
-        m = nn.Upsample(size=(224, 224), mode='bilinear')
-        unsampled_images = m(images)
+        unsampled_images = F.interpolate(images, size=(224, 224), mode='bilinear', align_corners=False)
         #print ('image feature size after unsample:', unsampled_images.size())
         features = self.resnet(unsampled_images)
         features = features.view(features.size(0), -1)
         features = self.bn(self.linear(features))
         return features
 
+class CAPTION_HEAD(nn.Module):
+    def __init__(self, embed_size, in_features=2048):
+        """Caption features from the pooled Inception-v3 features that
+        CNN_ENCODER already computes for the DAMSM loss."""
+        super(CAPTION_HEAD, self).__init__()
+        self.linear = nn.Linear(in_features, embed_size)
+        self.bn = nn.BatchNorm1d(embed_size, momentum=0.01)
+
+    def forward(self, pooled):
+        return self.bn(self.linear(pooled))
+
+
+class CAPTION_CNN_LITE(nn.Module):
+    def __init__(self, embed_size, size=224):
+        """ResNet-18 caption encoder, distilled from CAPTION_CNN."""
+        super(CAPTION_CNN_LITE, self).__init__()
+        resnet = models.resnet18(pretrained=True)
+        self.resnet = nn.Sequential(*list(resnet.children())[:-1])
+        self.linear = nn.Linear(resnet.fc.in_features, embed_size)
+        self.bn = nn.BatchNorm1d(embed_size, momentum=0.01)
+        self.size = size
+
+    def forward(self, images):
+        images = F.interpolate(images, size=(self.size, self.size), mode='bilinear', align_corners=False)
+        features = self.resnet(images)
+        features = features.view(features.size(0), -1)
+        return self.bn(self.linear(features))
+
+
+def caption_encoder(backbone, embed_size):
+    """Image side of the recaption loss for CAP.BACKBONE.
+
+    'resnet152' is CAPTION_CNN on the images, 'inception' is CAPTION_HEAD
+    on the pooled CNN_ENCODER features and 'distilled' is CAPTION_CNN_LITE
+    on the images.
+    """
+    if backbone == 'resnet152':
+        return CAPTION_CNN(embed_size)
+    if backbone == 'inception':
+        return CAPTION_HEAD(embed_size)
+    if backbone == 'distilled':
+        return CAPTION_CNN_LITE(embed_size)
+    raise ValueError('unknown caption backbone: %s' % backbone)
+
+
 class CAPTION_RNN(nn.Module):
     def __init__(self, embed_size, hidden_size, vocab_size, num_layers, max_seq_length=20):
         """Set the hyper-parameters and build the layers."""
@@ -346,16 +670,93 @@ class CAPTION_RNN(nn.Module):
         outputs = self.linear(hiddens[0])
         return outputs
 
-    def sample(self, features, states=None):
-        """Generate captions for given image features using greedy search."""
+    def forward_padded(self, features, captions):
+        """Logits for every position of the padded captions, without packing.
+
+        The LSTM is unidirectional, so the outputs within each caption
+        match those of forward; positions past cap_lens are left for the
+        caller to mask. --> batch x seq_len x vocab_size
+        """
+        embeddings = self.embed(captions[:, :-1])
+        embeddings = torch.cat((features.unsqueeze(1), embeddings), 1)
+        hiddens, _ = self.lstm(embeddings)
+        return self.linear(hiddens)
+
+    def sample(self, features, states=None, end_id=None):
+        """Generate captions for given image features using greedy search.
+
+        With end_id, decoding stops as soon as every caption has emitted it
+        and the tokens after it are set to end_id.
+        """
         sampled_ids = []
+        finished = None
         inputs = features.unsqueeze(1)
         for i in range(self.max_seg_length):
             hiddens, states = self.lstm(inputs, states)  # hiddens: (batch_size, 1, hidden_size)
             outputs = self.linear(hiddens.squeeze(1))  # outputs:  (batch_size, vocab_size)
             _, predicted = outputs.max(1)  # predicted: (batch_size)
+            if end_id is not None:
+                if finished is None:
+                    finished = predicted == end_id
+                else:
+                    predicted = predicted.masked_fill(finished, end_id)
+                    finished = finished | (predicted == end_id)
             sampled_ids.append(predicted)
+            if finished is not None and bool(finished.all()):
+                break
             inputs = self.embed(predicted)  # inputs: (batch_size, embed_size)
             inputs = inputs.unsqueeze(1)  # inputs: (batch_size, 1, embed_size)
-        sampled_ids = torch.stack(sampled_ids, 1)  # sampled_ids: (batch_size, max_seq_length)
-        return sampled_ids
\ No newline at end of file
+        sampled_ids = torch.stack(sampled_ids, 1)  # sampled_ids: (batch_size, <= max_seq_length)
+        return sampled_ids
+
+    def beam_search(self, features, beam_size=3, end_id=2, normalize=True):
+        """Batched beam search over all images at once.
+
+        The LSTM states of the batch x beam_size hypotheses are reordered
+        with index_select after every step instead of being recomputed.
+        Finished beams only extend with end_id at no cost, and decoding
+        stops once every beam has finished. normalize ranks the final
+        beams by their mean token log-probability.
+        --> batch x <= max_seq_length
+        """
+        batch_size = features.size(0)
+        hiddens, states = self.lstm(features.unsqueeze(1))
+        log_probs = F.log_softmax(self.linear(hiddens.squeeze(1)), 1)
+        vocab_size = log_probs.size(1)
+        # batch x beam_size
+        scores, tokens = log_probs.topk(beam_size, 1)
+        seqs = tokens.unsqueeze(2)
+        finished = tokens == end_id
+        lengths = torch.ones_like(tokens)
+        states = tuple(state.repeat_interleave(beam_size, dim=1) for state in states)
+
+        # log-probabilities of a finished beam: end_id again, for free
+        ended = torch.full((vocab_size,), -float('inf'), device=features.device)
+        ended[end_id] = 0
+        offsets = torch.arange(batch_size, device=features.device).unsqueeze(1) * beam_size
+        for i in range(1, self.max_seg_length):
+            if bool(finished.all()):
+                break
+            inputs = self.embed(seqs[:, :, -1].reshape(-1)).unsqueeze(1)
+            hiddens, states = self.lstm(inputs, states)
+            log_probs = F.log_softmax(self.linear(hiddens.squeeze(1)), 1)
+            log_probs = log_probs.view(batch_size, beam_size, vocab_size)
+            log_probs = torch.where(finished.unsqueeze(2), ended, log_probs)
+
+            # batch x beam_size*vocab_size --> best beam_size continuations
+            candidates = (scores.unsqueeze(2) + log_probs).view(batch_size, -1)
+            scores, index = candidates.topk(beam_size, 1)
+            beam = torch.div(index, vocab_size, rounding_mode='floor')
+            tokens = index % vocab_size
+
+            seqs = torch.cat((seqs.gather(1, beam.unsqueeze(2).expand(-1, -1, seqs.size(2))),
+                              tokens.unsqueeze(2)), 2)
+            was_finished = finished.gather(1, beam)
+            lengths = lengths.gather(1, beam) + (~was_finished).long()
+            finished = was_finished | (tokens == end_id)
+            states = tuple(state.index_select(1, (beam + offsets).view(-1)) for state in states)
+
+        if normalize:
+            scores = scores / lengths.float()
+        best = scores.argmax(1)
+        return seqs[torch.arange(batch_size, device=features.device), best]
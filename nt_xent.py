@@ -1,35 +1,119 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class NT_Xent(nn.Module):
 
-    def __init__(self, batch_size, temperature, mask, device):
+    def __init__(self, temperature):
         super(NT_Xent, self).__init__()
-        self.batch_size = batch_size
         self.temperature = temperature
-        self.mask = mask
-        self.device = device
 
         self.criterion = nn.CrossEntropyLoss(reduction="sum")
-        self.similarity_f = nn.CosineSimilarity(dim=2)
+        # (batch_size, device) -> (self-similarity mask, positive indices)
+        self._targets = {}
 
-    def forward(self, z_i, z_j):
+    def targets(self, batch_size, device):
+        """Mask of the self-similarities and the index of each positive in
+        the 2B x 2B similarity, built once per batch size and device."""
+        key = (batch_size, device)
+        if key not in self._targets:
+            n = 2 * batch_size
+            self_mask = torch.eye(n, dtype=torch.bool, device=device)
+            # the positive of sample i is sample (i + B) mod 2B
+            labels = (torch.arange(n, device=device) + batch_size) % n
+            self._targets[key] = (self_mask, labels)
+        return self._targets[key]
+
+    def forward(self, z_i, z_j, queue=None):
         """
         We do not sample negative examples explicitly.
         Instead, given a positive pair, similar to (Chen et al., 2017), we treat the other 2(N − 1) augmented examples within a minibatch as negative examples.
+        The embeddings of a NegativeQueue, if given, are added as negatives of every sample.
         """
+        batch_size = z_i.size(0)
 
-        p1 = torch.cat((z_i, z_j), dim=0)
-        sim = self.similarity_f(p1.unsqueeze(1), p1.unsqueeze(0)) / self.temperature
-
-        sim_i_j = torch.diag(sim, self.batch_size)
-        sim_j_i = torch.diag(sim, -self.batch_size)
+        # cosine similarity of all pairs: 2B x 2B, without a 2B x 2B x D temporary
+        p1 = F.normalize(torch.cat((z_i, z_j), dim=0), dim=1)
+        sim = torch.matmul(p1, p1.t()) / self.temperature
 
-        positive_samples = torch.cat((sim_i_j, sim_j_i), dim=0).reshape(self.batch_size * 2, 1)
-        negative_samples = sim[self.mask].reshape(self.batch_size * 2, -1)
-
-        labels = torch.zeros(self.batch_size * 2).to(self.device).long()
-        logits = torch.cat((positive_samples, negative_samples), dim=1)
+        # every row keeps its positive and the 2(N - 1) negatives
+        self_mask, labels = self.targets(batch_size, sim.device)
+        logits = sim.masked_fill(self_mask, -float('inf'))
+        if queue is not None:
+            # 2B x K, with the empty and stale entries masked out
+            negatives, valid = queue.negatives()
+            sim_q = torch.matmul(p1, negatives.t().to(p1.dtype)) / self.temperature
+            sim_q = sim_q.masked_fill(~valid, -float('inf'))
+            logits = torch.cat((logits, sim_q), dim=1)
         loss = self.criterion(logits, labels)
-        loss /= 2 * self.batch_size
+        loss /= 2 * batch_size
         return loss
+
+
+class NegativeQueue(nn.Module):
+    """Ring buffer of past embeddings, used as extra NT_Xent negatives.
+
+    enqueue overwrites the oldest entries once the queue is full and
+    dequeue drops the oldest ones. Entries enqueued more than max_age
+    enqueue calls ago count as stale and are masked out (0 keeps all).
+    The contents are buffers, so the queue is saved and restored through
+    its state_dict.
+    """
+
+    def __init__(self, size, dim, max_age=0):
+        super(NegativeQueue, self).__init__()
+        self.size = size
+        self.max_age = max_age
+        self.register_buffer('embeddings', torch.zeros(size, dim))
+        # enqueue step of each entry, -1 for an empty slot
+        self.register_buffer('ages', torch.full((size,), -1, dtype=torch.long))
+        self.register_buffer('step', torch.zeros((), dtype=torch.long))
+        self.register_buffer('ptr', torch.zeros((), dtype=torch.long))
+        self.register_buffer('count', torch.zeros((), dtype=torch.long))
+
+    def __len__(self):
+        return int(self.count)
+
+    @torch.no_grad()
+    def enqueue(self, z):
+        z = F.normalize(z.detach().float(), dim=1)[-self.size:]
+        n = z.size(0)
+        idx = (self.ptr + torch.arange(n, device=z.device)) % self.size
+        self.embeddings[idx] = z
+        self.ages[idx] = self.step
+        self.ptr.copy_((self.ptr + n) % self.size)
+        self.count.copy_((self.count + n).clamp(max=self.size))
+        self.step += 1
+
+    @torch.no_grad()
+    def dequeue(self, n):
+        n = min(n, len(self))
+        idx = (self.ptr - self.count + torch.arange(n, device=self.ages.device)) % self.size
+        self.ages[idx] = -1
+        self.count -= n
+
+    def negatives(self):
+        """All slots (normalized) and the mask of the usable ones.
+
+        The slots are a copy, so the loss graph that saves them for backward
+        survives an enqueue before that backward.
+        """
+        valid = self.ages >= 0
+        if self.max_age > 0:
+            valid = valid & (self.step - self.ages <= self.max_age)
+        return self.embeddings.clone(), valid
+
+
+if __name__ == '__main__':
+    # CPU check: forward with a queue, enqueue, then backward
+    torch.manual_seed(0)
+    criterion = NT_Xent(0.5)
+    queue = NegativeQueue(16, 8, max_age=2)
+    for step in range(3):
+        z_i = torch.randn(4, 8, requires_grad=True)
+        z_j = torch.randn(4, 8, requires_grad=True)
+        loss = criterion(z_i, z_j, queue)
+        queue.enqueue(torch.cat((z_i, z_j), 0))
+        loss.backward()
+        assert torch.isfinite(loss) and z_i.grad is not None
+        print('step %d: loss %.4f, queue %d' % (step, loss.item(), len(queue)))
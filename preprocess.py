@@ -0,0 +1,147 @@
+# -*- encoding: utf-8 -*-
+"""Offline preprocessing of a dataset split for SSA-GAN.
+
+--stage shards writes pre-resized image shards (IMG_SHARDS), text_embs the
+frozen text encoder outputs (TEXT.EMB_CACHE) and img_feats the real-image
+CNN_ENCODER features.
+
+    python preprocess.py --cfg cfg/bird.yml --split train --stage shards
+"""
+from __future__ import print_function
+
+import os
+import sys
+import pprint
+import argparse
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from miscc.config import cfg, cfg_from_file
+from datasets import TextDataset, ImageShards, EmbeddingStore, FeatureStore
+from DAMSM import RNN_ENCODER, CNN_ENCODER
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Preprocess a dataset for SSA-GAN')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file',
+                        default='cfg/bird.yml', type=str)
+    parser.add_argument('--data_dir', dest='data_dir', type=str, default='')
+    parser.add_argument('--split', dest='split', type=str, default='train')
+    parser.add_argument('--stage', dest='stage', type=str, default='shards',
+                        choices=['shards', 'text_embs', 'img_feats'])
+    parser.add_argument('--workers', dest='workers', type=int, default=4)
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=256)
+    args = parser.parse_args()
+    return args
+
+
+def build_shards(split, workers):
+    """Decode, crop and resize every image once into uint8 shards."""
+    cfg.IMG_SHARDS = False
+    dataset = TextDataset(cfg.DATA_DIR, split, base_size=cfg.TREE.BASE_SIZE)
+    ImageShards.build(dataset, dataset.shards_prefix(split),
+                      dataset.shards_size(), workers)
+
+
+def build_text_embs(split, batch_size):
+    """Encode every caption of the split once with the frozen RNN_ENCODER."""
+    cfg.TEXT.EMB_CACHE = False
+    dataset = TextDataset(cfg.DATA_DIR, split, base_size=cfg.TREE.BASE_SIZE)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    text_encoder = RNN_ENCODER(dataset.n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
+    state_dict = torch.load(cfg.TEXT.DAMSM_NAME, map_location=lambda storage, loc: storage)
+    text_encoder.load_state_dict(state_dict)
+    text_encoder.to(device)
+    text_encoder.eval()
+
+    num = len(dataset.captions)
+    store = EmbeddingStore(os.path.join(cfg.DATA_DIR, split, 'text_embs'))
+    words, sent = store.create(num, cfg.TEXT.EMBEDDING_DIM, cfg.TEXT.WORDS_NUM)
+    with torch.no_grad():
+        for start in range(0, num, batch_size):
+            end = min(start + batch_size, num)
+            caps, cap_lens = dataset.captions.pad(np.arange(start, end),
+                                                  cfg.TEXT.WORDS_NUM, shuffle=False)
+            caps, cap_lens = torch.from_numpy(caps), torch.from_numpy(cap_lens)
+            # the encoder packs its input, so sort by length and undo it after
+            sorted_cap_lens, sorted_cap_indices = torch.sort(cap_lens, 0, True)
+            _, ori_indices = torch.sort(sorted_cap_indices, 0)
+            hidden = text_encoder.init_hidden(end - start)
+            words_embs, sent_emb = text_encoder(caps[sorted_cap_indices].to(device),
+                                                sorted_cap_lens.to(device), hidden)
+            words_embs = words_embs[ori_indices.to(device)]
+            sent_emb = sent_emb[ori_indices.to(device)]
+            words[start:end, :, :words_embs.size(2)] = words_embs.cpu().numpy()
+            sent[start:end] = sent_emb.cpu().numpy()
+            if (start // batch_size) % 100 == 0:
+                print('text_embs: %d/%d' % (start, num))
+    words.flush()
+    sent.flush()
+    store.write_meta(num, cfg.TEXT.WORDS_NUM, cfg.TEXT.DAMSM_NAME)
+    print('Save to: ', store.prefix + '_words.npy')
+
+
+def build_img_feats(split, batch_size, workers):
+    """Run the frozen CNN_ENCODER once over the real images of the split."""
+    cfg.TEXT.EMB_CACHE = False
+    imsize = cfg.TREE.BASE_SIZE
+    # deterministic counterpart of the training transform
+    image_transform = transforms.Compose([
+        transforms.Resize(int(imsize * 76 / 64)),
+        transforms.CenterCrop(imsize)])
+    if cfg.IMG_SHARDS:
+        image_transform = transforms.CenterCrop(imsize)
+    dataset = TextDataset(cfg.DATA_DIR, split, base_size=imsize,
+                          transform=image_transform)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=False, num_workers=workers)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    image_encoder = CNN_ENCODER(cfg.TEXT.EMBEDDING_DIM)
+    img_encoder_path = cfg.TEXT.DAMSM_NAME.replace('text_encoder', 'image_encoder')
+    state_dict = \
+        torch.load(img_encoder_path, map_location=lambda storage, loc: storage)
+    image_encoder.load_state_dict(state_dict)
+    image_encoder.to(device)
+    image_encoder.eval()
+
+    store = FeatureStore(os.path.join(cfg.DATA_DIR, split, 'img_feats'))
+    regions, code = store.create(len(dataset), image_encoder.nef)
+    start = 0
+    with torch.no_grad():
+        for step, data in enumerate(dataloader, 0):
+            imgs = data[0][-1].to(device)
+            region_features, cnn_code = image_encoder(imgs)
+            end = start + imgs.size(0)
+            regions[start:end] = region_features.cpu().numpy()
+            code[start:end] = cnn_code.cpu().numpy()
+            start = end
+            if step % 100 == 0:
+                print('img_feats: %d/%d' % (start, len(dataset)))
+    regions.flush()
+    code.flush()
+    print('Save to: ', store.prefix + '_code.npy')
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.data_dir != '':
+        cfg.DATA_DIR = args.data_dir
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    if args.stage == 'shards':
+        build_shards(args.split, args.workers)
+    elif args.stage == 'text_embs':
+        build_text_embs(args.split, args.batch_size)
+    elif args.stage == 'img_feats':
+        build_img_feats(args.split, args.batch_size, args.workers)
@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+"""Caption a folder of images with the recaption models of a config.
+
+Images are streamed through the CAP.BACKBONE encoder in large batches and
+decoded by CAPTION_RNN with batched beam search (--beam_size 1 for greedy).
+Writes captions.txt, one caption per line in file name order for BLEU
+scoring, and captions.json mapping file names to captions.
+
+    python recaption.py --cfg cfg/bird.yml --image_dir <folder>
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import pickle
+import argparse
+
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from miscc.config import cfg, cfg_from_file
+from DAMSM import CNN_ENCODER
+from model import CAPTION_RNN, caption_encoder
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Caption a folder of images')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file',
+                        default='cfg/bird.yml', type=str)
+    parser.add_argument('--image_dir', dest='image_dir', type=str, required=True)
+    parser.add_argument('--out_dir', dest='out_dir', type=str, default='',
+                        help='defaults to --image_dir')
+    parser.add_argument('--vocab', dest='vocab', type=str, default='data/vocab.pkl')
+    parser.add_argument('--beam_size', dest='beam_size', type=int, default=3,
+                        help='1 decodes greedily')
+    parser.add_argument('--workers', dest='workers', type=int, default=4)
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=128)
+    args = parser.parse_args()
+    return args
+
+
+class Vocabulary(object):
+    """Stand-in for the class vocab.pkl was pickled with."""
+    pass
+
+
+class _VocabUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if name == 'Vocabulary':
+            return Vocabulary
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+def load_vocab(path):
+    """idx2word of the caption vocabulary (<pad>, <start>, <end>, <unk>, ...)."""
+    with open(path, 'rb') as f:
+        if sys.version_info > (3, 0):
+            vocab = _VocabUnpickler(f, encoding='latin1').load()
+        else:
+            vocab = _VocabUnpickler(f).load()
+    return vocab.idx2word, vocab.word2idx
+
+
+class ImageFolder(torch.utils.data.Dataset):
+    def __init__(self, image_dir, imsize):
+        self.image_dir = image_dir
+        self.filenames = sorted(name for name in os.listdir(image_dir)
+                                if name.lower().endswith(IMG_EXTENSIONS))
+        # same range as the generator output the caption models see in training
+        self.transform = transforms.Compose([
+            transforms.Resize((imsize, imsize)),
+            transforms.ToTensor(),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+    def __getitem__(self, index):
+        name = self.filenames[index]
+        img = Image.open(os.path.join(self.image_dir, name)).convert('RGB')
+        return self.transform(img), name
+
+    def __len__(self):
+        return len(self.filenames)
+
+
+def _frozen(model, path, device):
+    model.load_state_dict(torch.load(path, map_location=lambda storage, loc: storage))
+    for p in model.parameters():
+        p.requires_grad = False
+    return model.to(device).eval()
+
+
+def decode(sampled_ids, idx2word, word2idx):
+    """Token ids --> caption strings, cut at the first <end>."""
+    end_id, skip = word2idx['<end>'], (word2idx['<start>'], word2idx['<pad>'])
+    captions = []
+    for ids in sampled_ids.tolist():
+        words = []
+        for idx in ids:
+            if idx == end_id:
+                break
+            if idx not in skip:
+                words.append(idx2word[idx])
+        captions.append(' '.join(words))
+    return captions
+
+
+def recaption(args, device):
+    idx2word, word2idx = load_vocab(args.vocab)
+    end_id = word2idx['<end>']
+
+    dataset = ImageFolder(args.image_dir, cfg.TREE.BASE_SIZE)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, shuffle=False,
+        num_workers=args.workers, pin_memory=device.type == 'cuda')
+    print('Caption %d images from: %s' % (len(dataset), args.image_dir))
+
+    image_encoder = None
+    if cfg.CAP.BACKBONE == 'inception':
+        image_encoder = CNN_ENCODER(cfg.TEXT.EMBEDDING_DIM)
+        image_encoder = _frozen(image_encoder, cfg.TEXT.DAMSM_NAME.replace('text_encoder', 'image_encoder'), device)
+    caption_cnn_path = cfg.CAP.caption_cnn_path if cfg.CAP.BACKBONE == 'resnet152' \
+        else cfg.CAP.backbone_path
+    caption_cnn = _frozen(caption_encoder(cfg.CAP.BACKBONE, cfg.CAP.embed_size), caption_cnn_path, device)
+    caption_rnn = CAPTION_RNN(cfg.CAP.embed_size, cfg.CAP.hidden_size * 2, len(idx2word), cfg.CAP.num_layers)
+    caption_rnn = _frozen(caption_rnn, cfg.CAP.caption_rnn_path, device)
+
+    names, captions = [], []
+    with torch.no_grad():
+        for step, (imgs, batch_names) in enumerate(dataloader):
+            imgs = imgs.to(device, non_blocking=True)
+            if image_encoder is not None:
+                _, _, imgs = image_encoder(imgs, return_pooled=True)
+            features = caption_cnn(imgs)
+            if args.beam_size > 1:
+                sampled_ids = caption_rnn.beam_search(features, args.beam_size, end_id)
+            else:
+                sampled_ids = caption_rnn.sample(features, end_id=end_id)
+            names.extend(batch_names)
+            captions.extend(decode(sampled_ids, idx2word, word2idx))
+            if step % 20 == 0:
+                print('step: %d/%d' % (step, len(dataloader)))
+
+    out_dir = args.out_dir or args.image_dir
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    # one caption per line in file name order, as BLEU scorers expect hypotheses
+    with open(os.path.join(out_dir, 'captions.txt'), 'w') as f:
+        f.write('\n'.join(captions) + '\n')
+    with open(os.path.join(out_dir, 'captions.json'), 'w') as f:
+        json.dump(dict(zip(names, captions)), f, indent=1, sort_keys=True)
+    print('Save to: ', out_dir)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    recaption(args, device)